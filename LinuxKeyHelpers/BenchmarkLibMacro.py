@@ -0,0 +1,892 @@
+################################################################################
+#
+# Copyright © 2024 Marcus Behel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+################################################################################
+#
+# Benchmarks the libmacro event loop. Runs scripts against synthetic input
+# (key, scroll and motion storms) using the trace replay backend at maximum
+# speed, so no input devices or root access are needed.
+#
+# Reports events per second, CPU time per event and dispatch latency (time
+# from the backend returning an event to its generated output being sent to
+# the output sink, or to the script finishing handling it if it generated
+# nothing). Use --json to save results and --compare
+# to compare against results saved from another commit.
+#
+# --backend evdev feeds the same input as raw kernel input events through a
+# pipe into the direct evdev backend, so its read and decode path is included.
+# --backend evdev-thread does the same with the evdev backend read on a reader
+# thread (ThreadedBackend).
+#
+# --check-startup only checks libmacro's import time (python -X importtime)
+# against STARTUP_BUDGET_MS (or --check-startup MS) and that importing it
+# doesn't load evdev or other deferred modules. Exits with status 1 if not.
+#
+# --check-grab only replays keys into ToggleSprintBedrock on a grabbed evdev
+# device (through a pipe) and checks that exactly the keys it doesn't consume
+# are passed through to the uinput device. Exits with status 1 if not.
+#
+# --soak only runs millions of mixed key, scroll and motion events (generated
+# as they are read, so they aren't all in memory) through several scripts at
+# once using --backend and checks that the process's RSS stays flat once
+# warmed up. Then it runs as many events through LibinputBackend with a stub
+# libinput binding (StubLibinput) and checks that every event it got was
+# destroyed exactly once. Exits with status 1 if either fails.
+#
+# --jitter SECONDS instead measures timer wakeup jitter: how late LibMacro's
+# timers run (real clock, no input) with --load busy processes competing for
+# the CPU. Add --low-latency (and --cpu) to compare with low latency mode.
+#
+################################################################################
+
+
+from libmacro import LibMacro, LibMacroScript, InputBackend, WrappedBackend, OutputSink, MemorySink, TraceReplayBackend, EvdevBackend, EvdevDevice, ThreadedBackend, LowLatency
+from libmacro import on_chord, on_sequence, on_motion, MotionCurve, MotionBatch, LibinputEventType, ScrollAxis, SCROLL_V120, INPUT_EVENT
+from libmacro import ecodes, LibinputBackend, LibinputDeviceCapability, UINPUT_NAME
+from array import array
+from typing import Callable, List, Optional
+import ToggleSprintBedrock
+import ScrollFixGnomeWayland
+import libmacro
+import argparse
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+
+################################################################################
+# Synthetic input
+################################################################################
+
+def key_storm(count: int, rate: int) -> List[tuple]:
+    # Random typing (press + release pairs) including keys ToggleSprintBedrock reacts to
+    keys = [ecodes.KEY_A, ecodes.KEY_E, ecodes.KEY_Z, ecodes.KEY_ENTER, ecodes.KEY_ESC,
+            ecodes.KEY_LEFTCTRL, ecodes.KEY_LEFTSHIFT, ecodes.KEY_F9 + 1]
+    rng = random.Random(0)
+    events = []
+    t = 1000000
+    while len(events) < count:
+        key = rng.choice(keys)
+        events.append((t, LibinputEventType.KEYBOARD_KEY, key, 1))
+        t += 1000000 // rate
+        events.append((t, LibinputEventType.KEYBOARD_KEY, key, 0))
+        t += 1000000 // rate
+    return events[:count]
+
+def scroll_storm(count: int, rate: int) -> List[tuple]:
+    # Scroll wheel bursts that change direction every few detents
+    rng = random.Random(1)
+    events = []
+    t = 1000000
+    direction = 15.0
+    while len(events) < count:
+        for _ in range(rng.randint(1, 6)):
+            events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, ScrollAxis.VERTICAL, direction))
+            events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, SCROLL_V120 | ScrollAxis.VERTICAL, direction * 8))
+            t += 1000000 // rate
+        direction = -direction
+    return events[:count]
+
+def hires_storm(count: int, rate: int) -> List[tuple]:
+    # Free spinning hi-res wheel (1/8 detent per event) with some tilt
+    rng = random.Random(3)
+    events = []
+    t = 1000000
+    direction = 1.875
+    while len(events) < count:
+        for _ in range(rng.randint(50, 400)):
+            events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, ScrollAxis.VERTICAL, direction))
+            events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, SCROLL_V120 | ScrollAxis.VERTICAL, direction * 8))
+            if rng.random() < 0.1:
+                events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, ScrollAxis.HORIZONTAL, 1.875))
+                events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, SCROLL_V120 | ScrollAxis.HORIZONTAL, 15.0))
+            t += 1000000 // rate
+        direction = -direction
+    return events[:count]
+
+def motion_storm(count: int, rate: int) -> List[tuple]:
+    # High polling rate mouse movement (dx and dy share a timestamp)
+    rng = random.Random(2)
+    events = []
+    t = 1000000
+    while len(events) < count:
+        events.append((t, LibinputEventType.POINTER_MOTION, 0, rng.uniform(-4.0, 4.0)))
+        events.append((t, LibinputEventType.POINTER_MOTION, 1, rng.uniform(-4.0, 4.0)))
+        t += 1000000 // rate
+    return events[:count]
+
+STORMS = {
+    "key": (key_storm, 1000),
+    "scroll": (scroll_storm, 1000),
+    "hires": (hires_storm, 4000),
+    "motion": (motion_storm, 8000),
+}
+
+################################################################################
+
+
+
+################################################################################
+# Benchmark harness
+################################################################################
+
+class NoopScript(LibMacroScript):
+    def handle_key(self, keycode: int, pressed: bool):
+        pass
+
+    def handle_mouse_button(self, button: int, pressed: bool):
+        pass
+
+    def handle_mouse_scroll(self, vertical: bool, distance: float):
+        pass
+
+class BindingsScript(LibMacroScript):
+    # Dozens of chord and sequence bindings (added by add_bindings)
+    pass
+
+def add_bindings(cls: type, count: int):
+    keys = [ecodes.KEY_A, ecodes.KEY_E, ecodes.KEY_Z, ecodes.KEY_ENTER, ecodes.KEY_ESC, ecodes.KEY_F9 + 1]
+    ctrl = (ecodes.KEY_LEFTCTRL, ecodes.KEY_RIGHTCTRL)
+    for i in range(count):
+        a = keys[i % len(keys)]
+        b = keys[(i // len(keys)) % len(keys)]
+        setattr(cls, "chord{}".format(i), on_chord(ctrl, ecodes.KEY_LEFTSHIFT, a)(lambda self, pressed: None))
+        setattr(cls, "sequence{}".format(i), on_sequence(a, b, keys[i % 3], timeout=0.5)(lambda self: None))
+
+add_bindings(BindingsScript, 36)
+
+class MotionCurveScript(LibMacroScript):
+    # Sensitivity curve applied to every motion batch (sent through uinput)
+    curve = MotionCurve(lambda speed: min(2.0, 0.4 + 0.05 * speed))
+
+    @on_motion(output=True)
+    def motion(self, batch: MotionBatch):
+        batch.apply(self.curve)
+
+SCRIPTS = {
+    "noop": NoopScript,
+    "bindings": BindingsScript,
+    "curve": MotionCurveScript,
+    "ToggleSprintBedrock": ToggleSprintBedrock.Script,
+    "ScrollFixGnomeWayland": ScrollFixGnomeWayland.Script,
+}
+
+
+class CountingSink(OutputSink):
+    # Discards generated events (only counts them). Records the latency of
+    # the events whose output is sent (see BenchLibMacro).
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+        self.syns = 0
+        self.sends = 0
+        self.lm = None
+
+        # Batch start times of dispatched events with output not sent yet
+        self.waiting = []
+
+    def open(self, lm: LibMacro, events: dict):
+        self.lm = lm
+
+    def send(self, events: List[tuple]):
+        if len(self.waiting) != 0:
+            end = time.perf_counter_ns()
+            for start in self.waiting:
+                self.lm.record_latency(end - start)
+            self.waiting.clear()
+        self.sends += 1
+        for etype, _, _ in events:
+            if etype == ecodes.EV_SYN:
+                self.syns += 1
+            else:
+                self.writes += 1
+
+
+class TimedBackend(WrappedBackend):
+    # Wraps another backend and remembers when each batch was returned
+
+    def __init__(self, backend: InputBackend):
+        super().__init__(backend)
+        self.batch_start = 0
+
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        events = self.backend.read_events(deadline, ready)
+        self.batch_start = time.perf_counter_ns()
+        return events
+
+
+def to_evdev(events: List[tuple]) -> bytes:
+    # Convert synthetic events to kernel input events (one frame per timestamp)
+    data = bytearray()
+    for i, (t, evtype, code, value) in enumerate(events):
+        sec, usec = divmod(t, 1000000)
+        if evtype == LibinputEventType.POINTER_SCROLL_WHEEL:
+            # Sent as hi-res wheel events (the backend generates both values from them)
+            if code == SCROLL_V120 | ScrollAxis.VERTICAL:
+                data += INPUT_EVENT.pack(sec, usec, ecodes.EV_REL, ecodes.REL_WHEEL_HI_RES, -round(value))
+            elif code == SCROLL_V120 | ScrollAxis.HORIZONTAL:
+                data += INPUT_EVENT.pack(sec, usec, ecodes.EV_REL, ecodes.REL_HWHEEL_HI_RES, round(value))
+            # Axis events (libinput units) are covered by their v120 event
+        elif evtype == LibinputEventType.POINTER_MOTION:
+            data += INPUT_EVENT.pack(sec, usec, ecodes.EV_REL, ecodes.REL_X if code == 0 else ecodes.REL_Y, round(value))
+        else:
+            data += INPUT_EVENT.pack(sec, usec, ecodes.EV_KEY, code, int(value))
+        if i + 1 == len(events) or events[i + 1][0] != t:
+            data += INPUT_EVENT.pack(sec, usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0)
+    return bytes(data)
+
+def evdev_pipe_backend(events: List[tuple], grab: bool = False) -> EvdevBackend:
+    # Evdev backend reading from a pipe that a thread fills with the events
+    # Writes are whole events (and at most PIPE_BUF) so reads never split one
+    data = to_evdev(events)
+    r, w = os.pipe()
+    os.set_blocking(r, False)
+
+    def writer():
+        chunk = INPUT_EVENT.size * (4096 // INPUT_EVENT.size)
+        for i in range(0, len(data), chunk):
+            os.write(w, data[i:i + chunk])
+        os.close(w)
+    threading.Thread(target=writer, daemon=True).start()
+    return EvdevBackend(grab=grab, devices=[EvdevDevice(r, "benchmark")])
+
+
+class BenchLibMacro(LibMacro):
+    # Measures latency of every dispatched event
+    # Latency = time the event's output is sent (CountingSink.send), or end of
+    # dispatch if it queued no output - time the backend returned its batch
+    # Events taken in by the scroll burst or motion stage are instead
+    # measured until the stage's output is sent (or the stage flushed if it
+    # queued none), since the stages only generate output when they flush.
+
+    def __init__(self, script: LibMacroScript, backend: TimedBackend, sink: CountingSink, count: int):
+        super().__init__(script, backend, sink)
+        self.latencies = array("q", bytes(8 * count))
+        self.dispatched = 0
+
+        # Batch start times of events added to a stage that hasn't flushed yet
+        self.staged = []
+
+    def start(self):
+        super().start()
+        for stage in self.scroll_stages:
+            stage.flush = self.timed_flush(stage.flush)
+        if self.motion_stage is not None:
+            self.motion_stage.flush = self.timed_flush(self.motion_stage.flush)
+
+    def timed_flush(self, flush: Callable) -> Callable:
+        def timed():
+            queued = len(self.ui.pending)
+            flush()
+            if len(self.staged) == 0:
+                return
+            if len(self.ui.pending) != queued:
+                self.ui.waiting.extend(self.staged)
+            else:
+                end = time.perf_counter_ns()
+                for start in self.staged:
+                    self.record_latency(end - start)
+            self.staged.clear()
+        return timed
+
+    def dispatch(self, event: tuple):
+        evtype = event[1]
+        if (evtype == LibinputEventType.POINTER_SCROLL_WHEEL and len(self.scroll_stages) != 0) or \
+                (evtype == LibinputEventType.POINTER_MOTION and self.motion_stage is not None):
+            # Adding may flush the previous burst / batch (so staged is only
+            # added to afterwards)
+            super().dispatch(event)
+            self.staged.append(self.backend.batch_start)
+            return
+        queued = len(self.ui.pending)
+        super().dispatch(event)
+        if len(self.ui.pending) != queued:
+            self.ui.waiting.append(self.backend.batch_start)
+        else:
+            self.record_latency(time.perf_counter_ns() - self.backend.batch_start)
+
+    def record_latency(self, latency: int):
+        self.latencies[self.dispatched] = latency
+        self.dispatched += 1
+
+
+def percentile(values: List[int], p: float) -> int:
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run_benchmark(script_name: str, storm_name: str, count: int, backend_name: str) -> dict:
+    storm, rate = STORMS[storm_name]
+    events = storm(count, rate)
+    if backend_name == "evdev":
+        backend = evdev_pipe_backend(events)
+    elif backend_name == "evdev-thread":
+        backend = ThreadedBackend(evdev_pipe_backend(events))
+    else:
+        backend = TraceReplayBackend(events, realtime=False)
+    sink = CountingSink()
+    lm = BenchLibMacro(SCRIPTS[script_name](), TimedBackend(backend), sink, len(events))
+
+    # Scripts may print from handlers. Don't let the terminal slow things down.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        lm.run()
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+
+    latencies = sorted(lm.latencies[:lm.dispatched])
+    return {
+        "script": script_name,
+        "storm": storm_name,
+        "backend": backend_name,
+        "events": len(events),
+        "events_per_sec": len(events) / wall,
+        "cpu_ns_per_event": cpu * 1e9 / len(events),
+        "latency_p50_ns": percentile(latencies, 0.50),
+        "latency_p99_ns": percentile(latencies, 0.99),
+        "latency_max_ns": latencies[-1] if len(latencies) != 0 else 0,
+        "uinput_writes": sink.writes,
+        "uinput_syns": sink.syns,
+        "uinput_sends": sink.sends,
+    }
+
+################################################################################
+
+
+
+################################################################################
+# Wakeup jitter
+################################################################################
+
+class TickBackend(InputBackend):
+    # No input. Runs a timer every period seconds (absolute deadlines) and
+    # records how late each one ran. Finished after duration seconds.
+
+    def __init__(self, duration: float, period: float):
+        self.duration = duration
+        self.period = period
+        self.lm = None
+        self.end = 0.0
+        self.deadline = 0.0
+        self.lateness = array("q", bytes(8 * (int(duration / period) + 2)))
+        self.ticks = 0
+
+    def open(self, lm: LibMacro):
+        self.lm = lm
+        self.end = time.monotonic() + self.duration
+        self.deadline = time.monotonic() + self.period
+        lm.schedule(self.period, self.tick)
+
+    def tick(self):
+        now = time.monotonic()
+        if self.ticks < len(self.lateness):
+            self.lateness[self.ticks] = int((now - self.deadline) * 1e9)
+            self.ticks += 1
+        self.deadline += self.period
+        if self.deadline < self.end:
+            self.lm.schedule(self.deadline - now, self.tick)
+
+    def poll_timeout(self) -> int:
+        # Wake at the end even if no timer is pending
+        return max(0, int((self.end - time.monotonic()) * 1000) + 1)
+
+    def finished(self) -> bool:
+        return time.monotonic() >= self.end
+
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        return []
+
+def run_jitter(duration: float, period: float, load: int, low_latency: Optional[LowLatency]) -> dict:
+    busy = [subprocess.Popen([sys.executable, "-c", "while True: pass"]) for _ in range(load)]
+    try:
+        backend = TickBackend(duration, period)
+        lm = LibMacro(NoopScript(), backend, CountingSink(), low_latency=low_latency)
+        lm.run()
+    finally:
+        for proc in busy:
+            proc.kill()
+            proc.wait()
+    lateness = sorted(backend.lateness[:backend.ticks])
+    return {
+        "ticks": backend.ticks,
+        "load": load,
+        "low_latency": low_latency.applied if low_latency is not None else [],
+        "lateness_p50_ns": percentile(lateness, 0.50),
+        "lateness_p99_ns": percentile(lateness, 0.99),
+        "lateness_max_ns": lateness[-1] if len(lateness) != 0 else 0,
+    }
+
+################################################################################
+
+
+
+################################################################################
+# Soak
+################################################################################
+
+# Default number of events for --soak
+SOAK_EVENTS = 2000000
+
+# Events of each storm in one repetition of the soak input
+SOAK_STORM_EVENTS = 4096
+
+# RSS is sampled every this many events. The first samples (warm-up, up to
+# SOAK_WARMUP of the run) only fill caches, pools and the like.
+SOAK_SAMPLE_EVENTS = 20000
+SOAK_WARMUP = 0.1
+
+# Most RSS may grow after warm-up (allocator noise, not per event growth)
+SOAK_RSS_SLACK_KB = 2048
+
+class SoakEvents:
+    # Sequence of count events that repeats a mix of storms with times that
+    # keep increasing. Events are created when accessed, so millions of them
+    # can be replayed without holding them in memory.
+
+    def __init__(self, count: int):
+        self.count = count
+        self.base = []
+        t = 0
+        for storm_name in ("key", "scroll", "motion"):
+            storm, rate = STORMS[storm_name]
+            events = storm(SOAK_STORM_EVENTS, rate)
+            offset = t - events[0][0]
+            self.base.extend((et + offset, evtype, code, value) for et, evtype, code, value in events)
+            t = self.base[-1][0] + 1000
+        self.period = t
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        repeat, index = divmod(i, len(self.base))
+        t, evtype, code, value = self.base[index]
+        return (1000000 + t + repeat * self.period, evtype, code, value)
+
+def rss_kb() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+class RssSampler(WrappedBackend):
+    # Wraps another backend and samples RSS every SOAK_SAMPLE_EVENTS events
+
+    def __init__(self, backend: InputBackend):
+        super().__init__(backend)
+        self.events = 0
+        self.next_sample = 0
+        self.samples = array("q")
+
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        events = self.backend.read_events(deadline, ready)
+        self.events += len(events)
+        if self.events >= self.next_sample:
+            self.samples.append(rss_kb())
+            self.next_sample += SOAK_SAMPLE_EVENTS
+        return events
+
+def check_soak(count: int, backend_name: str) -> bool:
+    events = SoakEvents(count)
+    if backend_name == "evdev":
+        backend = evdev_pipe_backend(events)
+    elif backend_name == "evdev-thread":
+        backend = ThreadedBackend(evdev_pipe_backend(events))
+    else:
+        backend = TraceReplayBackend(events, realtime=False)
+    sampler = RssSampler(backend)
+    scripts = [ToggleSprintBedrock.Script(), ScrollFixGnomeWayland.Script(), BindingsScript(), MotionCurveScript()]
+    lm = LibMacro(scripts, sampler, CountingSink())
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        lm.run()
+    sampler.samples.append(rss_kb())
+
+    # The evdev backend combines some events (eg both scroll values come from
+    # one wheel event), so fewer events than generated may be read
+    samples = sampler.samples
+    warm_index = min(len(samples) - 1, int(len(samples) * SOAK_WARMUP))
+    warm = samples[warm_index]
+    growth = max(samples[warm_index:]) - warm
+    ok = growth <= SOAK_RSS_SLACK_KB
+    print("soak: {} events ({} backend), RSS after warm-up {} KiB, grew {} KiB (slack {} KiB){}".format(
+        sampler.events, backend_name, warm, growth, SOAK_RSS_SLACK_KB, "" if ok else "  FAILED"))
+    return ok
+
+# Device pointers handed out by StubLibinput
+STUB_KEYBOARD = 0x1000
+STUB_MOUSE = 0x2000
+STUB_UINPUT = 0x3000
+
+STUB_DEVICES = {
+    STUB_KEYBOARD: (b"soak keyboard", [LibinputDeviceCapability.KEYBOARD]),
+    STUB_MOUSE: (b"soak mouse", [LibinputDeviceCapability.POINTER]),
+    STUB_UINPUT: (UINPUT_NAME.encode(), [LibinputDeviceCapability.KEYBOARD, LibinputDeviceCapability.POINTER]),
+}
+
+# Events StubLibinput repeats: (type, device, code, value). Includes events
+# from libmacro's own uinput device, types no script subscribes to (touch,
+# gesture, buttons) and a mouse being unplugged and plugged back in.
+STUB_EVENTS = [
+    (LibinputEventType.KEYBOARD_KEY, STUB_KEYBOARD, ecodes.KEY_A, 1),
+    (LibinputEventType.KEYBOARD_KEY, STUB_KEYBOARD, ecodes.KEY_A, 0),
+    (LibinputEventType.POINTER_SCROLL_WHEEL, STUB_MOUSE, ScrollAxis.VERTICAL, 15.0),
+    (LibinputEventType.POINTER_SCROLL_WHEEL, STUB_MOUSE, ScrollAxis.VERTICAL, -15.0),
+    (LibinputEventType.POINTER_MOTION, STUB_MOUSE, 2.0, -1.0),
+    (LibinputEventType.POINTER_BUTTON, STUB_MOUSE, ecodes.BTN_LEFT, 1),
+    (LibinputEventType.POINTER_BUTTON, STUB_MOUSE, ecodes.BTN_LEFT, 0),
+    (LibinputEventType.KEYBOARD_KEY, STUB_UINPUT, ecodes.KEY_W, 1),
+    (LibinputEventType.KEYBOARD_KEY, STUB_UINPUT, ecodes.KEY_W, 0),
+    (500, STUB_MOUSE, 0, 0),                                # LIBINPUT_EVENT_TOUCH_DOWN
+    (800, STUB_MOUSE, 0, 0),                                # LIBINPUT_EVENT_GESTURE_SWIPE_BEGIN
+    (LibinputEventType.DEVICE_REMOVED, STUB_MOUSE, 0, 0),
+    (LibinputEventType.DEVICE_ADDED, STUB_MOUSE, 0, 0),
+]
+
+# Events StubLibinput makes available per libinput_dispatch call
+STUB_DISPATCH_EVENTS = 64
+
+class StubLibinput:
+    # Stands in for the libinput binding (libmacro.libinput) so LibinputBackend
+    # can be run without libinput or devices. Hands out count events (event
+    # pointers are ints) and counts how they are destroyed.
+
+    def __init__(self, count: int):
+        self.remaining = count
+        self.available = 0
+        self.issued = 0
+        self.live = {}              # event pointer: STUB_EVENTS entry
+        self.destroyed = 0
+        self.bad_destroys = 0       # Events destroyed twice (or never issued)
+        self.time = 1000000
+
+        # A context starts with DEVICE_ADDED for every device
+        self.added = [(LibinputEventType.DEVICE_ADDED, dev, 0, 0) for dev in STUB_DEVICES]
+
+    def libinput_dispatch(self, ctx) -> int:
+        self.available = min(STUB_DISPATCH_EVENTS, self.remaining)
+        return 0
+
+    def libinput_get_event(self, ctx):
+        if self.available == 0:
+            return None
+        self.available -= 1
+        self.remaining -= 1
+        self.issued += 1
+        self.time += 125
+        if self.issued <= len(self.added):
+            spec = self.added[self.issued - 1]
+        else:
+            spec = STUB_EVENTS[self.issued % len(STUB_EVENTS)]
+        ev = self.issued
+        self.live[ev] = spec
+        return ev
+
+    def libinput_event_destroy(self, ev):
+        if self.live.pop(ev, None) is None:
+            self.bad_destroys += 1
+        else:
+            self.destroyed += 1
+
+    def libinput_event_get_type(self, ev) -> int:
+        return self.live[ev][0]
+
+    def libinput_event_get_device(self, ev) -> int:
+        return self.live[ev][1]
+
+    def libinput_device_get_name(self, dev) -> bytes:
+        return STUB_DEVICES[dev][0]
+
+    def libinput_device_has_capability(self, dev, cap) -> int:
+        return 1 if cap in STUB_DEVICES[dev][1] else 0
+
+    def libinput_event_get_pointer_event(self, ev):
+        return ev
+
+    def libinput_event_get_keyboard_event(self, ev):
+        return ev
+
+    def libinput_event_pointer_get_time_usec(self, ev) -> int:
+        return self.time
+
+    def libinput_event_keyboard_get_time_usec(self, ev) -> int:
+        return self.time
+
+    def libinput_event_pointer_get_button(self, ev) -> int:
+        return self.live[ev][2]
+
+    def libinput_event_pointer_get_button_state(self, ev) -> int:
+        return self.live[ev][3]
+
+    def libinput_event_keyboard_get_key(self, ev) -> int:
+        return self.live[ev][2]
+
+    def libinput_event_keyboard_get_key_state(self, ev) -> int:
+        return self.live[ev][3]
+
+    def libinput_event_pointer_has_axis(self, ev, axis) -> int:
+        return 1 if self.live[ev][2] == axis else 0
+
+    def libinput_event_pointer_get_scroll_value(self, ev, axis) -> float:
+        return self.live[ev][3]
+
+    def libinput_event_pointer_get_scroll_value_v120(self, ev, axis) -> float:
+        return self.live[ev][3] * 8
+
+    def libinput_event_pointer_get_dx_unaccelerated(self, ev) -> float:
+        return self.live[ev][2]
+
+    def libinput_event_pointer_get_dy_unaccelerated(self, ev) -> float:
+        return self.live[ev][3]
+
+    def libinput_unref(self, ctx):
+        pass
+
+
+class StubLibinputBackend(LibinputBackend):
+    # LibinputBackend reading from a StubLibinput (no udev, context or fds)
+
+    def __init__(self, stub: StubLibinput):
+        super().__init__()
+        self.stub = stub
+
+    def open(self, lm: LibMacro):
+        self.types = lm.subscribed_types()
+        self.m_libinput = 1
+
+    def filenos(self) -> List[int]:
+        return []
+
+    def poll_timeout(self) -> int:
+        return 0
+
+    def finished(self) -> bool:
+        return self.stub.remaining == 0
+
+def check_libinput_soak(count: int) -> bool:
+    stub = StubLibinput(count)
+    sampler = RssSampler(StubLibinputBackend(stub))
+    scripts = [ToggleSprintBedrock.Script(), ScrollFixGnomeWayland.Script(), BindingsScript(), MotionCurveScript()]
+    lm = LibMacro(scripts, sampler, CountingSink())
+    real_libinput = libmacro.libinput
+    libmacro.libinput = stub
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            lm.run()
+    finally:
+        libmacro.libinput = real_libinput
+    sampler.samples.append(rss_kb())
+
+    samples = sampler.samples
+    warm_index = min(len(samples) - 1, int(len(samples) * SOAK_WARMUP))
+    growth = max(samples[warm_index:]) - samples[warm_index]
+    ok = stub.issued == count and stub.destroyed == stub.issued and stub.bad_destroys == 0 and growth <= SOAK_RSS_SLACK_KB
+    print("libinput soak: {} events issued, {} destroyed, {} not destroyed, {} destroyed twice, RSS grew {} KiB{}".format(
+        stub.issued, stub.destroyed, len(stub.live), stub.bad_destroys, growth, "" if ok else "  FAILED"))
+    return ok
+
+################################################################################
+
+
+
+################################################################################
+# Startup time
+################################################################################
+
+# Modules importing libmacro must not pull in (they are only needed once a
+# device or the async loop is actually used)
+STARTUP_FORBIDDEN_MODULES = ["evdev", "glob", "asyncio", "importlib.util", "traceback", "socket", "numpy"]
+
+# Longest libmacro may take to import (fastest of several runs). Scripts
+# import it before handling --help or --replay.
+STARTUP_BUDGET_MS = 50.0
+
+def measure_startup(runs: int) -> dict:
+    # Import libmacro in fresh interpreters using python -X importtime and keep
+    # the fastest run (least disturbed by other load on the machine)
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = "import sys, libmacro; print(' '.join(m for m in {} if m in sys.modules))".format(STARTUP_FORBIDDEN_MODULES)
+    best_us = None
+    loaded = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=here)
+        if proc.returncode != 0:
+            raise Exception("Importing libmacro failed:\n" + proc.stderr)
+        # Lines are "import time: self [us] | cumulative | module"
+        for line in proc.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "libmacro":
+                us = int(fields[1])
+                best_us = us if best_us is None else min(best_us, us)
+        loaded = proc.stdout.split()
+    return {"import_ms": best_us / 1000.0, "loaded": loaded}
+
+def check_startup(budget_ms: float, runs: int) -> bool:
+    startup = measure_startup(runs)
+    ok = startup["import_ms"] <= budget_ms and len(startup["loaded"]) == 0
+    print("libmacro import: {:.1f} ms (budget {:.1f} ms){}".format(startup["import_ms"], budget_ms, "" if ok else "  FAILED"))
+    if len(startup["loaded"]) != 0:
+        print("libmacro import loaded deferred modules: " + ", ".join(startup["loaded"]))
+    return ok
+
+################################################################################
+
+
+
+################################################################################
+# Grab pass-through check
+################################################################################
+
+# Keys typed on a grabbed keyboard running ToggleSprintBedrock and whether
+# each must reach the uinput device. Ctrl presses are handled (consumed),
+# Shift only has a release handler and W none (both passed through).
+GRAB_KEYS = [
+    (ecodes.KEY_W, 1, True),
+    (ecodes.KEY_LEFTCTRL, 1, False),
+    (ecodes.KEY_LEFTCTRL, 0, False),
+    (ecodes.KEY_LEFTSHIFT, 1, True),
+    (ecodes.KEY_LEFTSHIFT, 0, True),
+    (ecodes.KEY_W, 0, True),
+]
+
+def check_grab() -> bool:
+    events = [(i * 10000, LibinputEventType.KEYBOARD_KEY, code, value) for i, (code, value, _) in enumerate(GRAB_KEYS)]
+    sink = MemorySink()
+    lm = LibMacro(ToggleSprintBedrock.Script(), evdev_pipe_backend(events, grab=True), sink)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        lm.run()
+
+    expected = [(code, value) for code, value, forward in GRAB_KEYS if forward]
+    passed = [(code, value) for _, etype, code, value in sink.events
+              if etype == ecodes.EV_KEY and code != ecodes.KEY_F9]
+    generated = any(etype == ecodes.EV_KEY and code == ecodes.KEY_F9 for _, etype, code, _ in sink.events)
+    ok = passed == expected and generated
+    print("grabbed keys passed through: {}{}".format(passed, "" if ok else "  FAILED (expected {}{})".format(
+        expected, "" if generated else ", and F9 from the script")))
+    return ok
+
+################################################################################
+
+
+
+################################################################################
+# Output
+################################################################################
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def print_results(results: List[dict], baseline: Optional[dict]):
+    print("{:<22} {:<7} {:>12} {:>10} {:>10} {:>10} {:>10} {:>8}".format(
+        "script", "storm", "events/s", "cpu ns/ev", "p50 ns", "p99 ns", "max ns", "writes"))
+    for r in results:
+        line = "{:<22} {:<7} {:>12.0f} {:>10.0f} {:>10} {:>10} {:>10} {:>8}".format(
+            r["script"], r["storm"], r["events_per_sec"], r["cpu_ns_per_event"],
+            r["latency_p50_ns"], r["latency_p99_ns"], r["latency_max_ns"], r["uinput_writes"])
+        if baseline is not None:
+            old = baseline.get((r["script"], r["storm"]))
+            if old is not None:
+                line += "   events/s {:+.1f}%  p99 {:+.1f}%".format(
+                    100.0 * (r["events_per_sec"] / old["events_per_sec"] - 1.0),
+                    100.0 * (r["latency_p99_ns"] / max(1, old["latency_p99_ns"]) - 1.0))
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the libmacro event loop")
+    parser.add_argument("--scripts", nargs="+", choices=list(SCRIPTS), default=list(SCRIPTS))
+    parser.add_argument("--storms", nargs="+", choices=list(STORMS), default=list(STORMS))
+    parser.add_argument("--events", type=int, default=200000, help="Events per storm (default 200000)")
+    parser.add_argument("--backend", choices=["replay", "evdev", "evdev-thread"], default="replay", help="Input backend to benchmark (default replay)")
+    parser.add_argument("--json", metavar="FILE", help="Save results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="Compare with results saved using --json")
+    parser.add_argument("--jitter", metavar="SECONDS", type=float, help="Only measure timer wakeup jitter for this long")
+    parser.add_argument("--period", metavar="SECONDS", type=float, default=0.002, help="With --jitter, time between timers (default 0.002)")
+    parser.add_argument("--load", metavar="N", type=int, default=0, help="With --jitter, number of busy processes to run meanwhile")
+    parser.add_argument("--low-latency", action="store_true", help="With --jitter, use LibMacro's low latency mode")
+    parser.add_argument("--cpu", type=int, nargs="+", metavar="N", help="With --low-latency, only run on these CPUs")
+    parser.add_argument("--check-startup", metavar="MS", type=float, nargs="?", const=STARTUP_BUDGET_MS,
+                        help="Only check that importing libmacro takes at most MS milliseconds (default {:g}) and loads no deferred modules. Exits with status 1 if not.".format(STARTUP_BUDGET_MS))
+    parser.add_argument("--check-grab", action="store_true", help="Only check which keys of a grabbed device are passed through. Exits with status 1 if wrong.")
+    parser.add_argument("--soak", metavar="EVENTS", type=int, nargs="?", const=SOAK_EVENTS,
+                        help="Only run EVENTS (default {}) events through several scripts using --backend and check that RSS stays flat. Exits with status 1 if it grows.".format(SOAK_EVENTS))
+    args = parser.parse_args()
+
+    if args.soak is not None:
+        ok = check_soak(args.soak, args.backend)
+        ok = check_libinput_soak(args.soak) and ok
+        sys.exit(0 if ok else 1)
+
+    if args.check_grab:
+        sys.exit(0 if check_grab() else 1)
+
+    if args.check_startup is not None:
+        sys.exit(0 if check_startup(args.check_startup, 5) else 1)
+
+    if args.jitter is not None:
+        low_latency = LowLatency(cpus=args.cpu) if args.low_latency else None
+        result = run_jitter(args.jitter, args.period, args.load, low_latency)
+        print("timer lateness over {} ticks ({} busy processes): p50 {:.1f} us, p99 {:.1f} us, max {:.1f} us".format(
+            result["ticks"], result["load"], result["lateness_p50_ns"] / 1000,
+            result["lateness_p99_ns"] / 1000, result["lateness_max_ns"] / 1000))
+        if low_latency is not None:
+            print("low latency mode: " + ", ".join(result["low_latency"]))
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump({"commit": git_commit(), "python": sys.version.split()[0],
+                           "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "jitter": result}, f, indent=2)
+        return
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = {(r["script"], r["storm"]): r for r in json.load(f)["results"] if r.get("backend", "replay") == args.backend}
+
+    results = []
+    for script_name in args.scripts:
+        for storm_name in args.storms:
+            results.append(run_benchmark(script_name, storm_name, args.events, args.backend))
+    print_results(results, baseline)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "python": sys.version.split()[0],
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": results
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
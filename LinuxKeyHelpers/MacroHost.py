@@ -0,0 +1,62 @@
+################################################################################
+#
+# Copyright © 2024 Marcus Behel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+################################################################################
+#
+# Runs several libmacro scripts in one process. All scripts share one set of
+# input devices and one uinput device, so each input event is only read and
+# decoded once, and no script sees events generated by another script.
+#
+# Scripts are given as module names, file paths or module:ClassName (the
+# default class name is Script). Each event is passed to the scripts in the
+# order they are given. All other options are the same as for a single script
+# and come after the scripts (optionally separated by --).
+#
+# Example:
+#   python3 MacroHost.py ToggleSprintBedrock ScrollFixGnomeWayland --backend evdev
+#
+################################################################################
+
+
+
+from libmacro import load_script, run_script
+import argparse
+import sys
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="%(prog)s [-h] scripts [scripts ...] [--] [options]",
+                                     description="Run several libmacro scripts in one process",
+                                     epilog="Options after the scripts are passed on (same as running a single script, see ToggleSprintBedrock.py --help)")
+    parser.add_argument("scripts", nargs="+", help="Scripts to run (module, file.py or module:ClassName)")
+
+    # Scripts are everything before the first option (or --). Options for
+    # run_script could otherwise be taken for scripts (eg --backend evdev).
+    argv = sys.argv[1:]
+    count = next((i for i, arg in enumerate(argv) if arg.startswith("-")), len(argv))
+    if count == 0 and len(argv) != 0 and argv[0] not in ("-h", "--help"):
+        parser.error("scripts must come before options")
+    args = parser.parse_args(argv[:count] if count != 0 else argv[:1])
+    remaining = argv[count:]
+    if remaining[:1] == ["--"]:
+        remaining = remaining[1:]
+    run_script([load_script(spec) for spec in args.scripts], remaining)
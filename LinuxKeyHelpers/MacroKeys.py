@@ -0,0 +1,98 @@
+################################################################################
+#
+# Copyright © 2024 Marcus Behel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy 
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, 
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+################################################################################
+#
+# Records and plays back keyboard and mouse button / wheel macros.
+#
+# F10 starts recording, pressing it again stops recording and saves the macro
+# to macro.lmm (in the current directory). F11 plays the saved macro with the
+# recorded timing; pressing F11 while it plays stops it. The macro is kept
+# across runs of the script.
+#
+# Input is not grabbed, so recorded keys also reach other programs while
+# recording.
+#
+################################################################################
+
+
+
+from libmacro import ecodes
+from libmacro import LibMacroScript, Macro, run_script, on_key, log
+from typing import List
+import os
+
+MACRO_FILE = "macro.lmm"
+
+class Script(LibMacroScript):
+    # Every key, button and wheel event is needed for recording (without
+    # consuming them)
+    track_input_state = True
+    track_scroll = True
+
+    def __init__(self):
+        super().__init__()
+        self.recorder = None
+        self.player = None
+        self.macro = Macro.load(MACRO_FILE) if os.path.exists(MACRO_FILE) else Macro()
+
+    @on_key(ecodes.KEY_F10, pressed=True)
+    def record_pressed(self, keycode: int, pressed: bool):
+        if self.recorder is None:
+            self.stop_playing()
+            self.recorder = self.record_macro(exclude=[ecodes.KEY_F10, ecodes.KEY_F11])
+            log.info("RECORDING")
+        else:
+            self.macro = self.recorder.stop()
+            self.recorder = None
+            self.macro.save(MACRO_FILE)
+            log.info("RECORDED {} events ({:.1f} s)", len(self.macro), self.macro.duration())
+
+    @on_key(ecodes.KEY_F11, pressed=True)
+    def play_pressed(self, keycode: int, pressed: bool):
+        if self.recorder is not None:
+            return
+        if self.player is not None and self.player.playing():
+            self.stop_playing()
+            log.info("STOPPED")
+        else:
+            self.player = self.play_macro(self.macro, on_done=self.played)
+            log.info("PLAYING")
+
+    def played(self, player):
+        self.player = None
+
+    def stop_playing(self):
+        if self.player is not None:
+            self.player.stop()
+            self.player = None
+
+    def key_events_generated(self) -> List[int]:
+        # Any keyboard key and mouse button can be in a macro
+        return list(range(ecodes.KEY_ESC, ecodes.KEY_MICMUTE + 1)) + list(range(ecodes.BTN_LEFT, ecodes.BTN_TASK + 1))
+
+    def rel_events_generated(self) -> List[int]:
+        return [ecodes.REL_WHEEL, ecodes.REL_HWHEEL]
+
+
+if __name__ == "__main__":
+    run_script(Script())
@@ -40,9 +40,9 @@
 
 
 
-# Input event codes in ecodes. List at https://github.com/torvalds/linux/blob/master/include/uapi/linux/input-event-codes.h
-from evdev import ecodes
-from libmacro import LibMacro, LibMacroScript
+# Input event codes in ecodes (libmacro's, evdev.ecodes compatible). List at https://github.com/torvalds/linux/blob/master/include/uapi/linux/input-event-codes.h
+from libmacro import ecodes
+from libmacro import LibMacroScript, ScrollBurst, run_script, on_scroll_burst
 from typing import List
 
 class Script(LibMacroScript):
@@ -50,13 +50,12 @@ class Script(LibMacroScript):
         super().__init__()
         self.last_distance = 0.0
 
-    def handle_key(self, keycode: int, pressed: bool):
-        pass
-    
-    def handle_mouse_button(self, button: int, pressed: bool):
-        pass
-
-    def handle_mouse_scroll(self, vertical: bool, distance: float):
+    # Bursts never change direction, so one check per burst is enough
+    @on_scroll_burst()
+    def scroll_burst(self, burst: ScrollBurst):
+        distance = burst.vertical
+        if distance == 0.0:
+            return
         # If this is the first scroll in a different direction, repeat the event
         if distance > 0.0 and self.last_distance < 0.0:
             # Repeat first scroll down after scrolling up
@@ -71,6 +70,4 @@ class Script(LibMacroScript):
 
 
 if __name__ == "__main__":
-    print("STARTING. Press Ctrl+C to exit.")
-    lm = LibMacro(Script())
-    lm.run()
+    run_script(Script())
@@ -22,111 +22,2844 @@
 #
 ################################################################################
 
-# Requires libudev and libinput installed by distro
-# Requires python3-evdev package installed by distro
+# Requires libudev and libinput installed by distro (libinput backend only)
+# Requires python3-evdev package installed by distro (uinput output)
+# Neither is loaded until first used, so replaying a trace needs neither
 
 import ctypes
+import fcntl
+from ctypes import c_void_p, c_char_p, c_int, c_uint32, c_uint64, c_double
 import os
-import traceback
-import importlib
+import struct
+import signal
+import stat
+import sys
 from abc import ABC, abstractmethod
-from typing import Callable, Any, List
+from array import array
+from typing import Callable, Any, List, Optional, Tuple
 from enum import IntEnum
-from evdev import uinput, ecodes
 import select
 import time
+import contextlib
+import heapq
+import itertools
+import math
 
+# Other modules (evdev, glob, importlib, traceback, asyncio, socket, threading, etc) are
+# imported where they are used so importing libmacro stays fast for code that
+# never touches a device (replay, benchmarks, --help)
+
+
+################################################################################
+# Native library loading
+################################################################################
+
+class LazyLibrary:
+    # Shared library that is only loaded when a symbol is first used.
+    # symbols: name: (argtypes, restype) for every function that may be used.
+    # Each function is looked up and its types set on first use, then cached
+    # as an attribute (later uses don't go through __getattr__).
+
+    def __init__(self, name: str, filenames: List[str], symbols: dict, use_errno: bool = False):
+        self.name = name
+        self.filenames = filenames
+        self.symbols = symbols
+        self.use_errno = use_errno
+        self.lib = None
+
+    def load(self):
+        if self.lib is None:
+            errors = []
+            for filename in self.filenames:
+                try:
+                    self.lib = ctypes.CDLL(filename, use_errno=self.use_errno)
+                    break
+                except OSError as e:
+                    errors.append(str(e))
+            else:
+                raise Exception("Failed to load {} (tried {}). Make sure {} is installed.\n{}".format(
+                    self.name, ", ".join(self.filenames), self.name, "\n".join(errors)))
+        return self.lib
+
+    def __getattr__(self, symbol: str):
+        if symbol not in self.symbols:
+            raise AttributeError("{} has no symbol {} in its binding table".format(self.name, symbol))
+        fn = getattr(self.load(), symbol)
+        fn.argtypes, fn.restype = self.symbols[symbol]
+        setattr(self, symbol, fn)
+        return fn
+
+################################################################################
+
+
+
+################################################################################
+# Logging
+################################################################################
+
+# Handlers must never block on a slow terminal or journal pipe, so log calls
+# only store a record in a preallocated ring buffer. A background thread
+# formats the records and writes them (ERROR and above to stderr, the rest to
+# stdout). When the ring is full new records are dropped and counted.
+#
+#   from libmacro import log
+#   log.info("Sprint {}", "on")
+#
+# Messages use str.format and are only formatted by the writer thread. Each
+# message (format string) is limited to rate_limit records per second.
+# Logging is meant to be done from the event loop thread (one producer).
+
+class LogLevel(IntEnum):
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+# Records in the ring buffer (power of 2)
+LOG_RING_SIZE = 1024
+
+# Longest the writer thread sleeps without being woken (seconds)
+LOG_IDLE_WAIT = 0.25
+
+class Log:
+
+    def __init__(self, size: int = LOG_RING_SIZE):
+        self.level = LogLevel.INFO
+        self.rate_limit = 20            # Per message per second (0 = no limit)
+
+        # Ring buffer. Record n is in slot n & mask of each array.
+        # head is only changed by the producer, tail only by the writer.
+        self.mask = size - 1
+        self.times = array("d", bytes(8 * size))
+        self.levels = array("B", bytes(size))
+        self.messages = [None] * size
+        self.args = [None] * size
+        self.excs = [None] * size
+        self.head = 0
+        self.tail = 0
+
+        self.dropped = 0                # Ring full
+        self.suppressed = 0             # Rate limited
+        self.windows = {}               # message: [window start, count]
+
+        self.thread = None
+        self.wakeup = None
+        self.idle = False
+
+    def start(self):
+        # Start the writer thread (done by LibMacro.start, otherwise by the
+        # first record)
+        if self.thread is not None:
+            return
+        import threading
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.writer, name="libmacro-log", daemon=True)
+        self.thread.start()
+
+    def debug(self, message: str, *args: Any):
+        self.push(LogLevel.DEBUG, message, args, None)
+
+    def info(self, message: str, *args: Any):
+        self.push(LogLevel.INFO, message, args, None)
+
+    def warning(self, message: str, *args: Any):
+        self.push(LogLevel.WARNING, message, args, None)
+
+    def error(self, message: str, *args: Any):
+        self.push(LogLevel.ERROR, message, args, None)
+
+    def exception(self, message: str, *args: Any):
+        # ERROR record followed by the traceback of the exception being handled
+        self.push(LogLevel.ERROR, message, args, sys.exc_info())
+
+    def push(self, level: int, message: str, args: tuple, exc: Optional[tuple]):
+        if level < self.level:
+            return
+        now = time.monotonic()
+        if self.rate_limit > 0:
+            window = self.windows.get(message)
+            if window is None or now - window[0] >= 1.0:
+                self.windows[message] = [now, 1]
+            elif window[1] >= self.rate_limit:
+                self.suppressed += 1
+                return
+            else:
+                window[1] += 1
+
+        head = self.head
+        if head - self.tail > self.mask:
+            self.dropped += 1
+            return
+        slot = head & self.mask
+        self.times[slot] = now
+        self.levels[slot] = level
+        self.messages[slot] = message
+        self.args[slot] = args
+        self.excs[slot] = exc
+        self.head = head + 1
+
+        if self.thread is None:
+            self.start()
+        elif self.idle:
+            self.wakeup.set()
+
+    def flush(self, timeout: float = 1.0):
+        # Wait (at most timeout seconds) for everything logged to be written
+        if self.thread is None:
+            return
+        end = time.monotonic() + timeout
+        while self.tail != self.head and time.monotonic() < end:
+            self.wakeup.set()
+            time.sleep(0.001)
+
+    def writer(self):
+        reported_dropped = 0
+        reported_suppressed = 0
+        while True:
+            self.write_records()
+            if self.dropped != reported_dropped or self.suppressed != reported_suppressed:
+                self.write(LogLevel.WARNING, "libmacro: {} log records dropped (buffer full), {} rate limited\n".format(
+                    self.dropped - reported_dropped, self.suppressed - reported_suppressed))
+                reported_dropped = self.dropped
+                reported_suppressed = self.suppressed
+            self.idle = True
+            if self.tail == self.head:
+                self.wakeup.wait(LOG_IDLE_WAIT)
+            self.idle = False
+            self.wakeup.clear()
+
+    def write_records(self):
+        head = self.head
+        tail = self.tail
+        while tail != head:
+            slot = tail & self.mask
+            level = self.levels[slot]
+            try:
+                text = self.messages[slot].format(*self.args[slot])
+            except Exception as e:
+                text = "{!r} {!r} (format failed: {})".format(self.messages[slot], self.args[slot], e)
+            if level >= LogLevel.WARNING:
+                text = LogLevel(level).name + ": " + text
+            text += "\n"
+            exc = self.excs[slot]
+            if exc is not None:
+                import traceback
+                text += "".join(traceback.format_exception(*exc))
+            self.messages[slot] = None
+            self.args[slot] = None
+            self.excs[slot] = None
+            self.write(level, text)
+            tail += 1
+            # Free the slot only once it is written (flush waits for this)
+            self.tail = tail
+
+    def write(self, level: int, text: str):
+        stream = sys.stderr if level >= LogLevel.ERROR else sys.stdout
+        try:
+            stream.write(text)
+            stream.flush()
+        except (OSError, ValueError):
+            # Closed or broken stream. Nothing else can be done with it.
+            pass
+
+log = Log()
+
+################################################################################
+
+
+
+################################################################################
+# libinput support
+################################################################################
+
+CFUNC_OPEN_RESTRICTED = ctypes.CFUNCTYPE( ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p)
+CFUNC_CLOSE_RESTRICTED = ctypes.CFUNCTYPE(None,  ctypes.c_int,  ctypes.c_void_p)
+
+class libinput_interface(ctypes.Structure):
+    _fields_ = [
+        ("open_restricted", CFUNC_OPEN_RESTRICTED),
+        ("close_restricted",  CFUNC_CLOSE_RESTRICTED)
+    ]
+
+def libinput_open_restricted(path, flags, user_data):
+    return os.open(path, flags)
+
+def libinput_close_restricted(fd, user_data):
+    os.close(fd)
+
+# Symbols used from libinput: name: (argtypes, restype)
+LIBINPUT_SYMBOLS = {
+    "libinput_udev_create_context": ([c_void_p, c_void_p, c_void_p], c_void_p),
+    "libinput_udev_assign_seat": ([c_void_p, c_char_p], c_int),
+    "libinput_unref": ([c_void_p], c_void_p),
+    "libinput_dispatch": ([c_void_p], c_int),
+    "libinput_get_event": ([c_void_p], c_void_p),
+    "libinput_event_get_type": ([c_void_p], c_int),
+    "libinput_event_get_pointer_event": ([c_void_p], c_void_p),
+    "libinput_event_pointer_get_button": ([c_void_p], c_uint32),
+    "libinput_event_pointer_get_button_state": ([c_void_p], c_int),
+    "libinput_event_pointer_has_axis": ([c_void_p, c_int], c_int),
+    "libinput_event_pointer_get_scroll_value": ([c_void_p, c_int], c_double),
+    "libinput_event_pointer_get_scroll_value_v120": ([c_void_p, c_int], c_double),
+    "libinput_event_pointer_get_dx_unaccelerated": ([c_void_p], c_double),
+    "libinput_event_pointer_get_dy_unaccelerated": ([c_void_p], c_double),
+    "libinput_event_get_keyboard_event": ([c_void_p], c_void_p),
+    "libinput_event_keyboard_get_key": ([c_void_p], c_uint32),
+    "libinput_event_keyboard_get_key_state": ([c_void_p], c_int),
+    "libinput_event_destroy": ([c_void_p], None),
+    "libinput_get_fd": ([c_void_p], c_int),
+    "libinput_event_get_device": ([c_void_p], c_void_p),
+    "libinput_device_get_name": ([c_void_p], c_char_p),
+    "libinput_event_keyboard_get_time_usec": ([c_void_p], c_uint64),
+    "libinput_event_pointer_get_time_usec": ([c_void_p], c_uint64),
+    "libinput_path_create_context": ([c_void_p, c_void_p], c_void_p),
+    "libinput_path_add_device": ([c_void_p, c_char_p], c_void_p),
+    "libinput_path_remove_device": ([c_void_p], None),
+    "libinput_device_has_capability": ([c_void_p, c_int], c_int),
+}
+
+libinput = LazyLibrary("libinput", ["libinput.so.10", "libinput.so"], LIBINPUT_SYMBOLS)
+
+# enum libinput_event_type (only the ones libmacro uses)
+class LibinputEventType(IntEnum):
+    DEVICE_ADDED = 1
+    DEVICE_REMOVED = 2
+    KEYBOARD_KEY = 300
+    POINTER_MOTION = 400
+    POINTER_BUTTON = 402
+    POINTER_SCROLL_WHEEL = 404
+
+# enum libinput_device_capability
+class LibinputDeviceCapability(IntEnum):
+    KEYBOARD = 0
+    POINTER = 1
+    TOUCH = 2
+    TABLET_TOOL = 3
+    TABLET_PAD = 4
+    GESTURE = 5
+    SWITCH = 6
+
+# enum libinput_pointer_axis
+class ScrollAxis(IntEnum):
+    VERTICAL = 0
+    HORIZONTAL = 1
+
+# Scroll events with code SCROLL_V120 | axis carry the high resolution value
+# of the axis event just before them (v120: 120 per wheel detent, hi-res
+# wheels send fractions of a detent)
+SCROLL_V120 = 2
+
+################################################################################
+
+
+
+################################################################################
+# libudev support
+################################################################################
+
+# Symbols used from libudev: name: (argtypes, restype)
+UDEV_SYMBOLS = {
+    "udev_new": ([], c_void_p),
+    "udev_unref": ([c_void_p], c_void_p),
+    "udev_monitor_new_from_netlink": ([c_void_p, c_char_p], c_void_p),
+    "udev_monitor_filter_add_match_subsystem_devtype": ([c_void_p, c_char_p, c_char_p], c_int),
+    "udev_monitor_enable_receiving": ([c_void_p], c_int),
+    "udev_monitor_get_fd": ([c_void_p], c_int),
+    "udev_monitor_receive_device": ([c_void_p], c_void_p),
+    "udev_monitor_unref": ([c_void_p], c_void_p),
+    "udev_device_get_action": ([c_void_p], c_char_p),
+    "udev_device_get_devnode": ([c_void_p], c_char_p),
+    "udev_device_unref": ([c_void_p], c_void_p),
+}
+
+udev = LazyLibrary("libudev", ["libudev.so.1", "libudev.so"], UDEV_SYMBOLS)
+
+class UdevMonitor:
+    # Reports input event devices (/dev/input/event*) added or removed after it
+    # was created
+    # fileno() becomes readable when there is something to report
+
+    def __init__(self, m_udev):
+        self.m_monitor = udev.udev_monitor_new_from_netlink(m_udev, b"udev")
+        if self.m_monitor is None:
+            raise Exception("Failed to initialize udev monitor.")
+        udev.udev_monitor_filter_add_match_subsystem_devtype(self.m_monitor, b"input", None)
+        udev.udev_monitor_enable_receiving(self.m_monitor)
+        self.fd = udev.udev_monitor_get_fd(self.m_monitor)
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def device_changes(self) -> List[Tuple[str, str]]:
+        # (action, path) of devices added ("add") or removed ("remove") since
+        # the last call, in order (non-blocking)
+        changes = []
+        while True:
+            dev = udev.udev_monitor_receive_device(self.m_monitor)
+            if dev is None:
+                break
+            try:
+                action = udev.udev_device_get_action(dev)
+                devnode = udev.udev_device_get_devnode(dev)
+                if action in (b"add", b"remove") and devnode is not None and devnode.startswith(b"/dev/input/event"):
+                    changes.append((action.decode(), devnode.decode()))
+            finally:
+                udev.udev_device_unref(dev)
+        return changes
+
+    def close(self):
+        if self.m_monitor is not None:
+            udev.udev_monitor_unref(self.m_monitor)
+            self.m_monitor = None
+
+################################################################################
+
+
+
+################################################################################
+# Kernel input definitions
+################################################################################
+
+# From linux/input.h and linux/input-event-codes.h
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_REL = 0x02
+EV_ABS = 0x03
+SYN_REPORT = 0
+SYN_DROPPED = 3
+REL_X = 0x00
+REL_Y = 0x01
+REL_HWHEEL = 0x06
+REL_WHEEL = 0x08
+REL_WHEEL_HI_RES = 0x0b
+REL_HWHEEL_HI_RES = 0x0c
+REL_CNT = 0x10
+KEY_A = 30
+BTN_MISC = 0x100
+BTN_LEFT = 0x110
+KEY_OK = 0x160
+CLOCK_MONOTONIC = 1
+
+# Number of key / button codes (KEY_MAX + 1)
+KEY_CNT = 0x300
+
+# struct input_event (native layout: struct timeval, __u16 type, __u16 code, __s32 value)
+INPUT_EVENT = struct.Struct("llHHi")
+
+def key_event_type(code: int) -> int:
+    # Keys and buttons share codes. Buttons are reported as POINTER_BUTTON.
+    if BTN_MISC <= code < KEY_OK:
+        return LibinputEventType.POINTER_BUTTON
+    return LibinputEventType.KEYBOARD_KEY
+
+# Event type for evdev events from grabbed devices that the scripts don't
+# consume (PASSTHROUGH | EV_SYN / EV_KEY / EV_REL, with the evdev code and
+# value). LibMacro sends them on unchanged through the uinput device.
+PASSTHROUGH = 0xff00
+PASSTHROUGH_MASK = 0xff00
+
+class KernelCodes:
+    # Input event codes for scripts, used like evdev.ecodes. The codes used
+    # by the bundled scripts are defined here, so importing them (eg for
+    # --help or --replay) doesn't load evdev. Any other code is looked up in
+    # evdev.ecodes on first use.
+    EV_SYN = EV_SYN
+    EV_KEY = EV_KEY
+    EV_REL = EV_REL
+    SYN_REPORT = SYN_REPORT
+    REL_X = REL_X
+    REL_Y = REL_Y
+    REL_HWHEEL = REL_HWHEEL
+    REL_WHEEL = REL_WHEEL
+    REL_WHEEL_HI_RES = REL_WHEEL_HI_RES
+    REL_HWHEEL_HI_RES = REL_HWHEEL_HI_RES
+    KEY_ESC = 1
+    KEY_W = 17
+    KEY_E = 18
+    KEY_ENTER = 28
+    KEY_LEFTCTRL = 29
+    KEY_A = KEY_A
+    KEY_LEFTSHIFT = 42
+    KEY_Z = 44
+    KEY_RIGHTSHIFT = 54
+    KEY_F9 = 67
+    KEY_F10 = 68
+    KEY_F11 = 87
+    KEY_RIGHTCTRL = 97
+    KEY_MICMUTE = 248
+    BTN_LEFT = BTN_LEFT
+    BTN_TASK = 0x117
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            from evdev import ecodes as evdev_ecodes
+        except ImportError:
+            # So hasattr / getattr with a default still work without evdev
+            raise AttributeError("Input event code {} needs evdev (not installed)".format(name)) from None
+        value = getattr(evdev_ecodes, name)
+        setattr(self, name, value)
+        return value
+
+ecodes = KernelCodes()
+
+################################################################################
+
+
+
+################################################################################
+# Device registry
+################################################################################
+
+UINPUT_NAME = "libmacro-uinput"
+
+class DeviceInfo:
+    # Metadata for one libinput device. Looked up once when the device is
+    # added instead of on every event.
+
+    def __init__(self, ptr: int):
+        self.ptr = ptr
+        self.name = libinput.libinput_device_get_name(ptr).decode(errors="replace")
+        self.capabilities = set()
+        for cap in LibinputDeviceCapability:
+            if libinput.libinput_device_has_capability(ptr, cap):
+                self.capabilities.add(cap)
+
+        # Events from libmacro's own uinput device must be ignored
+        # (otherwise generated events would be handled as input)
+        self.ours = self.name == UINPUT_NAME
+
+class DeviceRegistry:
+    # Tracks devices by libinput device pointer using DEVICE_ADDED and
+    # DEVICE_REMOVED events. The pointer stays valid (and unique) until the
+    # device is removed.
+
+    def __init__(self):
+        self.devices = {}
+
+        # Pointers of libmacro's own devices. Checked for every input event.
+        self.ours = set()
+
+    def add(self, ptr: int) -> DeviceInfo:
+        # Devices may be added before their DEVICE_ADDED event (path backend)
+        info = self.devices.get(ptr)
+        if info is not None:
+            return info
+        info = DeviceInfo(ptr)
+        self.devices[ptr] = info
+        if info.ours:
+            self.ours.add(ptr)
+        return info
+
+    def remove(self, ptr: int):
+        self.devices.pop(ptr, None)
+        self.ours.discard(ptr)
+
+    def clear(self):
+        self.devices.clear()
+        self.ours.clear()
+
+################################################################################
+
+
+
+################################################################################
+# Timer support
+################################################################################
+
+# Symbols used from libc: name: (argtypes, restype)
+LIBC_SYMBOLS = {
+    "timerfd_create": ([c_int, c_int], c_int),
+    "timerfd_settime": ([c_int, c_int, c_void_p, c_void_p], c_int),
+    "mlockall": ([c_int], c_int),
+    "munlockall": ([], c_int),
+}
+
+libc = LazyLibrary("libc", ["libc.so.6"], LIBC_SYMBOLS, use_errno=True)
+
+# From sys/timerfd.h
+TFD_TIMER_ABSTIME = 1
+TFD_NONBLOCK = os.O_NONBLOCK
+TFD_CLOEXEC = os.O_CLOEXEC
+
+class Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+class Itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", Timespec), ("it_value", Timespec)]
+
+class TimerHandle:
+    # Returned by LibMacro.schedule. Call cancel() to prevent a pending timer
+    # from running. Cancelled timers stay in the heap and are skipped when
+    # their deadline is reached (cheaper than removing them from the heap).
+
+    def __init__(self, deadline: float, fn: Callable, args: tuple):
+        self.deadline = deadline
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.done = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def pending(self) -> bool:
+        return not self.cancelled and not self.done
+
+
+class TimerFd:
+    # CLOCK_MONOTONIC timerfd armed with the next timer's absolute deadline
+    # (ns resolution). Polled with the input file descriptors, so timers wake
+    # the event loop at their deadline instead of after a poll timeout
+    # rounded up to whole milliseconds.
+
+    def __init__(self):
+        fd = libc.timerfd_create(CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "timerfd_create: " + os.strerror(errno))
+        self.fd = fd
+        self.spec = Itimerspec()
+        self.armed = None
+
+    def arm(self, deadline: Optional[float]):
+        # Expire at deadline (clock() seconds). None disarms.
+        if deadline == self.armed:
+            return
+        self.armed = deadline
+        if deadline is None:
+            self.spec.it_value.tv_sec = 0
+            self.spec.it_value.tv_nsec = 0
+        else:
+            # Rounded up so it never expires before the deadline
+            # (0 would disarm it, so at least 1 ns)
+            ns = max(1, math.ceil(deadline * 1e9))
+            self.spec.it_value.tv_sec, self.spec.it_value.tv_nsec = divmod(ns, 1000000000)
+        if libc.timerfd_settime(self.fd, TFD_TIMER_ABSTIME, ctypes.byref(self.spec), None) < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "timerfd_settime: " + os.strerror(errno))
+
+    def expired(self):
+        # Clear the readable state (called when poll reports it). Must be
+        # re-armed even if the next deadline is the same.
+        self.armed = None
+        try:
+            os.read(self.fd, 8)
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+        self.fd = -1
+
+################################################################################
+
+
+
+################################################################################
+# Input backends and output sinks
+################################################################################
+
+# Input events are passed from backends to LibMacro as plain tuples
+#   (time, type, code, value)
+# time:  Event time in microseconds (CLOCK_MONOTONIC, from the kernel)
+# type:  LibinputEventType
+# code:  Key / button code for KEYBOARD_KEY and POINTER_BUTTON
+#        ScrollAxis (or SCROLL_V120 | ScrollAxis) for POINTER_SCROLL_WHEEL
+#        0 (x) or 1 (y) for POINTER_MOTION
+# value: 1 (pressed) or 0 (released) for KEYBOARD_KEY and POINTER_BUTTON
+#        Scroll distance (libinput units and sign) for POINTER_SCROLL_WHEEL
+#        (v120 units, same sign, for SCROLL_V120 codes)
+#        Relative motion for POINTER_MOTION (unaccelerated, x and y events
+#        with the same time for each movement)
+#
+# Backends that grab devices also return PASSTHROUGH events (see Kernel input
+# definitions) for everything they read that the scripts don't handle.
+
+class InputBackend(ABC):
+    # Source of input events
+    # Set fds_changed to True when filenos() changes (eg device hot-plugged)
+
+    fds_changed = False
+
+    # Number of input events lost (eg buffer overflow). Backends that can't
+    # tell how many were lost add 1. LibMacro resyncs when it changes.
+    dropped = 0
+
+    def open(self, lm: "LibMacro"):
+        pass
+
+    def close(self):
+        pass
+
+    def filenos(self) -> List[int]:
+        # File descriptors to poll (POLLIN) for new events
+        return []
+
+    def poll_timeout(self) -> int:
+        # Milliseconds until read_events needs to be called even if no file
+        # descriptor is readable (-1 = only when readable)
+        return -1
+
+    def clock(self) -> float:
+        # Current time in seconds. Used for timers.
+        return time.monotonic()
+
+    def monotonic_clock(self) -> bool:
+        # True if clock() is CLOCK_MONOTONIC (so timers can use a timerfd)
+        return True
+
+    def finished(self) -> bool:
+        # True once no more events will ever be returned
+        return False
+
+    def key_state(self) -> Optional[bytearray]:
+        # Keys and buttons currently held on the input devices (KEY_CNT bit
+        # mask) or None if the backend can't tell
+        return None
+
+    def passthrough_capabilities(self) -> dict:
+        # Codes PASSTHROUGH events may have ({EV_KEY: [...], EV_REL: [...]}).
+        # Added to the uinput device. Called after open.
+        return {}
+
+    def lost_passthrough(self, state: Optional[bytearray]) -> List[int]:
+        # Keys whose press was passed through but that are not held in state
+        # (from key_state, None = all of them), so their release was lost.
+        # They are forgotten (their release is no longer passed through).
+        return []
+
+    @abstractmethod
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        # Return all events that are currently available (may be empty)
+        # deadline is the clock() time of the next pending timer (or None).
+        # Backends using a virtual clock must not advance their clock past it.
+        # ready is the list of file descriptors (from filenos) that are readable.
+        pass
+
+
+class WrappedBackend(InputBackend):
+    # Base of backends that wrap another backend. Everything is forwarded to
+    # the wrapped backend, so wrappers only override what they change.
+
+    def __init__(self, backend: InputBackend):
+        self.backend = backend
+
+    def open(self, lm: "LibMacro"):
+        self.backend.open(lm)
+
+    def close(self):
+        self.backend.close()
+
+    # Set and cleared by LibMacro / the wrapped backend, so it is the wrapped
+    # backend's flag
+    @property
+    def fds_changed(self) -> bool:
+        return self.backend.fds_changed
+
+    @fds_changed.setter
+    def fds_changed(self, changed: bool):
+        self.backend.fds_changed = changed
+
+    @property
+    def dropped(self) -> int:
+        return self.backend.dropped
+
+    def filenos(self) -> List[int]:
+        return self.backend.filenos()
+
+    def poll_timeout(self) -> int:
+        return self.backend.poll_timeout()
+
+    def clock(self) -> float:
+        return self.backend.clock()
+
+    def monotonic_clock(self) -> bool:
+        return self.backend.monotonic_clock()
+
+    def finished(self) -> bool:
+        return self.backend.finished()
+
+    def key_state(self) -> Optional[bytearray]:
+        return self.backend.key_state()
+
+    def passthrough_capabilities(self) -> dict:
+        return self.backend.passthrough_capabilities()
+
+    def lost_passthrough(self, state: Optional[bytearray]) -> List[int]:
+        return self.backend.lost_passthrough(state)
+
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        return self.backend.read_events(deadline, ready)
+
+
+class OutputSink(ABC):
+    # Destination of generated input events. Same interface as evdev's UInput
+    # (scripts use lm.ui.write and lm.ui.syn)
+    #
+    # Events are queued and sent together by commit(). LibMacro commits after
+    # handling each batch of input events and after running timers, so all
+    # output from one pass through the event loop is sent at once.
+    #
+    # syn() ends the current frame (SYN_REPORT). Repeated syn() calls with no
+    # writes in between are dropped. Inside frame() (or begin_frame() /
+    # end_frame()) syn() is ignored and a single SYN_REPORT is added when the
+    # outermost frame ends, so all writes in the frame are seen at once.
+
+    def __init__(self):
+        self.pending = []
+        self.frame_depth = 0
+        self.frame_dirty = False
+
+        # Keys currently held down by generated events (released on exit)
+        self.held = set()
+
+        # Capabilities the device was opened with (set by LibMacro.start)
+        self.capabilities = None
+
+        # Number of send() calls and events sent (including EV_SYN)
+        self.sends = 0
+        self.events_sent = 0
+
+        # Set by LibMacro.run_async. Writes made outside the event loop's
+        # pass (eg from a coroutine handler after an await) are committed
+        # from a callback on this loop.
+        self.loop = None
+        self.commit_scheduled = False
+
+    def open(self, lm: "LibMacro", events: dict):
+        # events: capabilities (same format as UInput), {EV_KEY: [...], EV_REL: [...]}
+        pass
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def send(self, events: List[tuple]):
+        # Send queued (type, code, value) events (including EV_SYN events)
+        pass
+
+    def write(self, etype: int, code: int, value: int):
+        self.pending.append((etype, code, value))
+        self.frame_dirty = True
+        if etype == EV_KEY:
+            if value != 0:
+                self.held.add(code)
+            else:
+                self.held.discard(code)
+        if self.loop is not None and not self.commit_scheduled:
+            self.commit_scheduled = True
+            self.loop.call_soon(self.commit)
+
+    def syn(self):
+        if self.frame_depth == 0 and self.frame_dirty:
+            self.pending.append((EV_SYN, SYN_REPORT, 0))
+            self.frame_dirty = False
+
+    def discard(self):
+        # Drop queued events that were not sent yet (and forget held keys)
+        self.pending.clear()
+        self.held.clear()
+        self.frame_depth = 0
+        self.frame_dirty = False
+
+    def release_held(self):
+        # Release all keys held by generated events (in one frame)
+        self.frame_depth = 0
+        for code in list(self.held):
+            self.write(EV_KEY, code, 0)
+        self.syn()
+
+    def begin_frame(self):
+        self.frame_depth += 1
+
+    def end_frame(self):
+        self.frame_depth -= 1
+        self.syn()
+
+    @contextlib.contextmanager
+    def frame(self):
+        self.begin_frame()
+        try:
+            yield self
+        finally:
+            self.end_frame()
+
+    def commit(self):
+        # Send everything written so far (unless a frame is still open)
+        self.commit_scheduled = False
+        if self.frame_depth != 0:
+            return
+        self.syn()
+        if len(self.pending) != 0:
+            events = self.pending
+            self.pending = []
+            self.sends += 1
+            self.events_sent += len(events)
+            self.send(events)
+
+
+# Device capabilities needed to produce each event type
+EVENT_CAPABILITIES = {
+    LibinputEventType.KEYBOARD_KEY: LibinputDeviceCapability.KEYBOARD,
+    LibinputEventType.POINTER_MOTION: LibinputDeviceCapability.POINTER,
+    LibinputEventType.POINTER_BUTTON: LibinputDeviceCapability.POINTER,
+    LibinputEventType.POINTER_SCROLL_WHEEL: LibinputDeviceCapability.POINTER,
+}
+
+class LibinputBackend(InputBackend):
+    # Real input devices using libinput and udev
+    #
+    # filter_devices = True:  Only devices that can generate events the
+    #                         script is subscribed to are opened (eg only
+    #                         keyboards for a script that only handles keys).
+    #                         Uses a path based libinput context and a udev
+    #                         monitor to follow hot-plugged devices.
+    # filter_devices = False: Every device on the seat is opened.
+
+    def __init__(self, seat: str = "seat0", filter_devices: bool = True):
+        self.seat = seat
+        self.filter_devices = filter_devices
+        self.devices = DeviceRegistry()
+
+        # Devices opened by path (path based context). libinput doesn't
+        # remove them when unplugged, so udev remove events do.
+        self.paths = {}
+        self.types = set()
+        self.capabilities = set()
+        self.m_udev = None
+        self.m_libinput = None
+        self.monitor = None
+
+    def open(self, lm: "LibMacro"):
+        self.types = lm.subscribed_types()
+        self.capabilities = set(EVENT_CAPABILITIES[t] for t in self.types if t in EVENT_CAPABILITIES)
+
+        # Initialize udev and libinput to monitor input events
+        self.m_udev = udev.udev_new()
+        self.m_libinput_iface  = libinput_interface(CFUNC_OPEN_RESTRICTED(libinput_open_restricted), CFUNC_CLOSE_RESTRICTED(libinput_close_restricted))
+        if not self.filter_devices:
+            self.m_libinput = libinput.libinput_udev_create_context(ctypes.byref(self.m_libinput_iface), None, self.m_udev)
+            rc = libinput.libinput_udev_assign_seat(self.m_libinput, self.seat.encode())
+            if rc != 0:
+                raise Exception("Failed to initialize libinput and udev. Try running as root.")
+            return
+
+        self.m_libinput = libinput.libinput_path_create_context(ctypes.byref(self.m_libinput_iface), None)
+        if self.m_libinput is None:
+            raise Exception("Failed to initialize libinput.")
+
+        # Monitor for hot-plugged devices before adding existing ones so none are missed
+        self.monitor = UdevMonitor(self.m_udev)
+
+        # A script with no subscriptions needs no devices
+        if len(self.capabilities) == 0:
+            return
+        import glob
+        paths = sorted(glob.glob("/dev/input/event*"))
+        opened = 0
+        for path in paths:
+            if self.add_device(path):
+                opened += 1
+        if len(paths) != 0 and opened == 0 and not os.access(paths[0], os.R_OK):
+            raise Exception("Failed to open input devices. Try running as root.")
+
+    def add_device(self, path: str) -> bool:
+        # Open a device, then close it again if it can't generate anything the
+        # script handles (or is libmacro's own uinput device). Paths already
+        # open are skipped (hot-plugged while open() looked for devices).
+        if path in self.paths:
+            return True
+        dev = libinput.libinput_path_add_device(self.m_libinput, path.encode())
+        if dev is None:
+            return False
+        info = self.devices.add(dev)
+        if info.ours or info.capabilities.isdisjoint(self.capabilities):
+            self.devices.remove(dev)
+            libinput.libinput_path_remove_device(dev)
+            return False
+        self.paths[path] = dev
+        return True
+
+    def remove_device(self, path: str):
+        # Close an unplugged device (libinput then sends DEVICE_REMOVED)
+        dev = self.paths.pop(path, None)
+        if dev is not None:
+            libinput.libinput_path_remove_device(dev)
+
+    def close(self):
+        self.paths.clear()
+        self.devices.clear()
+        if self.m_libinput is not None:
+            libinput.libinput_unref(self.m_libinput)
+            self.m_libinput = None
+        if self.monitor is not None:
+            self.monitor.close()
+            self.monitor = None
+        if self.m_udev is not None:
+            udev.udev_unref(self.m_udev)
+            self.m_udev = None
+
+    def filenos(self) -> List[int]:
+        fds = [libinput.libinput_get_fd(self.m_libinput)]
+        if self.monitor is not None:
+            fds.append(self.monitor.fileno())
+        return fds
+
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        # Open hot-plugged devices and close unplugged ones
+        if self.monitor is not None and self.monitor.fileno() in ready:
+            for action, path in self.monitor.device_changes():
+                if action == "add":
+                    self.add_device(path)
+                else:
+                    self.remove_device(path)
+
+        events = []
+        while True:
+            libinput.libinput_dispatch(self.m_libinput)
+            ev = libinput.libinput_get_event(self.m_libinput)
+            if ev is None:
+                break # No more events to handle
+
+            # Every event must be destroyed, even if it is skipped
+            # or translating it raises
+            try:
+                self.translate_event(ev, events)
+            finally:
+                libinput.libinput_event_destroy(ev)
+        return events
+
+    def translate_event(self, ev, events: list):
+        evtype = libinput.libinput_event_get_type(ev)
+        dev = libinput.libinput_event_get_device(ev)
+
+        if evtype == LibinputEventType.DEVICE_ADDED:
+            self.devices.add(dev)
+            return
+        elif evtype == LibinputEventType.DEVICE_REMOVED:
+            self.devices.remove(dev)
+            for path, ptr in list(self.paths.items()):
+                if ptr == dev:
+                    del self.paths[path]
+            return
+
+        # Don't handle events generated by libmacro's input device
+        # or events the script is not subscribed to
+        if evtype not in self.types or dev in self.devices.ours:
+            return
+
+        if evtype == LibinputEventType.POINTER_BUTTON:
+            # Mouse buttons
+            pev = libinput.libinput_event_get_pointer_event(ev)
+            events.append((
+                libinput.libinput_event_pointer_get_time_usec(pev),
+                evtype,
+                libinput.libinput_event_pointer_get_button(pev),
+                1 if libinput.libinput_event_pointer_get_button_state(pev) else 0
+            ))
+
+        elif evtype == LibinputEventType.POINTER_SCROLL_WHEEL:
+            # Scroll wheel (0 = vertical, 1 = horizontal)
+            # One libinput event can have both axes (diagonal / tilt wheels)
+            pev = libinput.libinput_event_get_pointer_event(ev)
+            t = libinput.libinput_event_pointer_get_time_usec(pev)
+            for axis in ScrollAxis:
+                if libinput.libinput_event_pointer_has_axis(pev, axis):
+                    events.append((t, evtype, axis, libinput.libinput_event_pointer_get_scroll_value(pev, axis)))
+                    events.append((t, evtype, SCROLL_V120 | axis, libinput.libinput_event_pointer_get_scroll_value_v120(pev, axis)))
+
+        elif evtype == LibinputEventType.KEYBOARD_KEY:
+            # Keyboard keys
+            kev = libinput.libinput_event_get_keyboard_event(ev)
+            events.append((
+                libinput.libinput_event_keyboard_get_time_usec(kev),
+                evtype,
+                libinput.libinput_event_keyboard_get_key(kev),
+                1 if libinput.libinput_event_keyboard_get_key_state(kev) else 0
+            ))
+
+        elif evtype == LibinputEventType.POINTER_MOTION:
+            # Relative motion without pointer acceleration (x then y)
+            pev = libinput.libinput_event_get_pointer_event(ev)
+            t = libinput.libinput_event_pointer_get_time_usec(pev)
+            events.append((t, evtype, 0, libinput.libinput_event_pointer_get_dx_unaccelerated(pev)))
+            events.append((t, evtype, 1, libinput.libinput_event_pointer_get_dy_unaccelerated(pev)))
+
+
+class UInputSink(OutputSink):
+    # Generates real input events using a uinput device
+    # All queued events are sent with a single write (kernel sets timestamps)
+
+    def __init__(self, name: str = UINPUT_NAME):
+        super().__init__()
+        self.name = name
+        self.ui = None
+
+    def open(self, lm: "LibMacro", events: dict):
+        from evdev import uinput
+        self.ui = uinput.UInput(events, name=self.name)
+
+    def close(self):
+        if self.ui is not None:
+            self.ui.close()
+            self.ui = None
+
+    def send(self, events: List[tuple]):
+        os.write(self.ui.fd, b"".join([INPUT_EVENT.pack(0, 0, etype, code, value) for etype, code, value in events]))
+
+
+class MemorySink(OutputSink):
+    # Stores generated events in a list instead of generating real input
+    # Each entry is (clock time, type, code, value). syn() is stored as
+    # (clock time, EV_SYN, SYN_REPORT, 0)
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+        self.lm = None
+
+    def open(self, lm: "LibMacro", events: dict):
+        self.lm = lm
+
+    def send(self, events: List[tuple]):
+        now = self.lm.clock()
+        self.events.extend((now, etype, code, value) for etype, code, value in events)
+
+################################################################################
+
+
+
+################################################################################
+# Direct evdev backend
+################################################################################
+
+def evdev_ioc(direction: int, nr: int, size: int) -> int:
+    return (direction << 30) | (size << 16) | (ord("E") << 8) | nr
+
+def EVIOCGNAME(length: int) -> int:
+    return evdev_ioc(2, 0x06, length)
+
+def EVIOCGBIT(ev: int, length: int) -> int:
+    return evdev_ioc(2, 0x20 + ev, length)
+
+def EVIOCGKEY(length: int) -> int:
+    return evdev_ioc(2, 0x18, length)
+
+EVIOCGRAB = evdev_ioc(1, 0x90, 4)
+EVIOCSCLOCKID = evdev_ioc(1, 0xa0, 4)
+
+def has_bit(bits: bytearray, bit: int) -> bool:
+    return bits[bit >> 3] & (1 << (bit & 7)) != 0
+
+# Events read from a device with one read() call
+EVDEV_READ_EVENTS = 256
+
+class EvdevDevice:
+    # One open event device and the state of the frame being decoded
+
+    def __init__(self, fd: int, name: str = "", path: str = "", hires: bool = False, grabbed: bool = False):
+        self.fd = fd
+        self.name = name
+        self.path = path
+        self.hires = hires          # Has REL_WHEEL_HI_RES (ignore REL_WHEEL)
+        self.grabbed = grabbed      # Opened with EVIOCGRAB (unconsumed events are passed through)
+        self.grab_pending = False   # To be grabbed once no keys are held (see EvdevBackend.try_grab)
+
+        # Read buffer (reused for every read)
+        self.buf = bytearray(INPUT_EVENT.size * EVDEV_READ_EVENTS)
+        self.view = memoryview(self.buf)
+
+        # Relative motion and wheel (v120 units) accumulated until SYN_REPORT
+        self.dx = 0
+        self.dy = 0
+        self.wheel = 0
+        self.hwheel = 0
+
+        # After SYN_DROPPED everything up to the next SYN_REPORT is discarded
+        self.dropped = False
+
+        # Frame has PASSTHROUGH events (so needs a PASSTHROUGH SYN_REPORT)
+        self.passthrough = False
+
+    def close(self):
+        os.close(self.fd)
+
+
+class EvdevBackend(InputBackend):
+    # Reads input devices (/dev/input/event*) directly instead of using
+    # libinput. Each readable device is drained with a few large reads into a
+    # preallocated buffer which is decoded in bulk.
+    #
+    # Only keyboard keys, mouse buttons, scroll wheels and relative motion are
+    # supported (no touchpads, tablets, etc).
+    #
+    # Like LibinputBackend, only devices that can generate events the script
+    # handles are opened. Devices are opened non-exclusively unless grab is
+    # True, in which case nothing else (including the desktop) receives their
+    # events. Grabbed devices keep working through uinput: everything the
+    # scripts don't consume (see LibMacro.compile_subscriptions) is also
+    # returned as PASSTHROUGH events. A key / button release is passed through
+    # when its press was.
+    #
+    # A device is only grabbed once none of its keys are held, otherwise the
+    # desktop would never see the release of a key it saw pressed (eg the
+    # Enter that started the script). Until then it is read like without grab.
+    # Devices are never grabbed (only read like without grab) if they have
+    # absolute axes (touchpads, tablets, touchscreens), since EV_ABS events
+    # can't be passed through, or if they are hot-plugged once the uinput
+    # device exists and can generate codes it doesn't have.
+    #
+    # devices: Use these already open devices instead of opening
+    #          /dev/input/event* (no hot-plug). Backend is finished once they
+    #          are all closed (read returns EOF or fails).
+
+    def __init__(self, grab: bool = False, devices: Optional[List[EvdevDevice]] = None):
+        self.grab = grab
+        self.given = devices
+        self.devices = {}           # fd: EvdevDevice
+        self.paths = {}             # path: EvdevDevice (opened by add_device)
+        self.types = set()
+        self.passthrough_keys = set()
+        self.passthrough_rels = set()
+
+        # What the scripts consume (from LibMacro) and keys whose press was
+        # passed through (so their release is too)
+        self.consumed_keys = bytearray(KEY_CNT)
+        self.consumed_scroll = bytearray(2 * len(ScrollAxis))
+        self.consumed_motion = False
+        self.forwarded = bytearray(KEY_CNT)
+        self.lm = None
+        self.m_udev = None
+        self.monitor = None
+        self.fds_changed = False
+
+    def open(self, lm: "LibMacro"):
+        self.lm = lm
+        self.types = lm.subscribed_types()
+        self.consumed_keys = lm.consumed_keys
+        self.consumed_scroll = lm.consumed_scroll
+        self.consumed_motion = lm.consumed_motion
+        if self.given is not None:
+            # Already open (and grabbed if needed), so only their events are passed through
+            for dev in self.given:
+                dev.grabbed = self.grab
+                self.devices[dev.fd] = dev
+            return
+
+        # Monitor for hot-plugged devices before adding existing ones so none are missed
+        self.m_udev = udev.udev_new()
+        self.monitor = UdevMonitor(self.m_udev)
+        if len(self.types) == 0:
+            return
+        import glob
+        paths = sorted(glob.glob("/dev/input/event*"))
+        for path in paths:
+            self.add_device(path)
+        if len(paths) != 0 and len(self.devices) == 0 and not os.access(paths[0], os.R_OK):
+            raise Exception("Failed to open input devices. Try running as root.")
+
+    def add_device(self, path: str):
+        # Open a device if it can generate events the script handles. Paths
+        # already open are skipped (hot-plugged while open() looked for devices).
+        if path in self.paths:
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError:
+            return
+        try:
+            name = bytearray(256)
+            fcntl.ioctl(fd, EVIOCGNAME(len(name)), name, True)
+            name = name.split(b"\0", 1)[0].decode(errors="replace")
+            ev_bits = bytearray(4)
+            fcntl.ioctl(fd, EVIOCGBIT(0, len(ev_bits)), ev_bits, True)
+            key_bits = bytearray(KEY_CNT // 8)
+            if has_bit(ev_bits, EV_KEY):
+                fcntl.ioctl(fd, EVIOCGBIT(EV_KEY, len(key_bits)), key_bits, True)
+            rel_bits = bytearray(2)
+            if has_bit(ev_bits, EV_REL):
+                fcntl.ioctl(fd, EVIOCGBIT(EV_REL, len(rel_bits)), rel_bits, True)
+            grab = self.grab and not has_bit(ev_bits, EV_ABS)
+
+            keyboard = has_bit(key_bits, KEY_A)
+            pointer = has_bit(key_bits, BTN_LEFT) or has_bit(rel_bits, REL_X) or has_bit(rel_bits, REL_WHEEL)
+            caps = set()
+            if keyboard:
+                caps.add(LibinputDeviceCapability.KEYBOARD)
+            if pointer:
+                caps.add(LibinputDeviceCapability.POINTER)
+            needed = any(EVENT_CAPABILITIES.get(t) in caps for t in self.types)
+            if not needed or name == UINPUT_NAME:
+                os.close(fd)
+                return
+
+            # Same timestamps as libinput uses
+            fcntl.ioctl(fd, EVIOCSCLOCKID, struct.pack("i", CLOCK_MONOTONIC))
+        except OSError:
+            os.close(fd)
+            return
+
+        if grab:
+            keys = set(code for code in range(KEY_CNT) if has_bit(key_bits, code) and not self.consumed_keys[code])
+            rels = set(code for code in range(REL_CNT)
+                       if has_bit(rel_bits, code) and (self.forward_rel(code, 1) or self.forward_rel(code, -1)))
+            ui_caps = self.lm.ui.capabilities if self.lm is not None else None
+            if ui_caps is None:
+                # Still starting, so the uinput device will have them
+                self.passthrough_keys.update(keys)
+                self.passthrough_rels.update(rels)
+            elif not keys.issubset(ui_caps.get(EV_KEY, ())) or not rels.issubset(ui_caps.get(EV_REL, ())):
+                log.info("Not grabbing {}: the uinput device can't pass all of its events through", name)
+                grab = False
+
+        dev = EvdevDevice(fd, name, path, has_bit(rel_bits, REL_WHEEL_HI_RES))
+        dev.grab_pending = grab
+        self.devices[fd] = dev
+        self.paths[path] = dev
+        self.fds_changed = True
+        if grab:
+            self.try_grab(dev)
+
+    def try_grab(self, dev: EvdevDevice):
+        # Grab a device unless some of its keys are held. Checked after
+        # grabbing, so a key pressed meanwhile can't be missed. Called again
+        # after each read until it succeeds (releasing a key makes the device
+        # readable).
+        state = bytearray(KEY_CNT // 8)
+        try:
+            fcntl.ioctl(dev.fd, EVIOCGRAB, 1)
+        except OSError as e:
+            log.warning("Failed to grab {}: {}", dev.name, e.strerror)
+            dev.grab_pending = False
+            return
+        try:
+            fcntl.ioctl(dev.fd, EVIOCGKEY(len(state)), state, True)
+        except OSError:
+            pass
+        if any(state):
+            try:
+                fcntl.ioctl(dev.fd, EVIOCGRAB, 0)
+            except OSError:
+                pass
+            return
+        dev.grab_pending = False
+        dev.grabbed = True
+
+    def remove_device(self, dev: EvdevDevice):
+        del self.devices[dev.fd]
+        if self.paths.get(dev.path) is dev:
+            del self.paths[dev.path]
+        dev.close()
+        self.fds_changed = True
+
+    def close(self):
+        for dev in list(self.devices.values()):
+            self.remove_device(dev)
+        if self.monitor is not None:
+            self.monitor.close()
+            self.monitor = None
+        if self.m_udev is not None:
+            udev.udev_unref(self.m_udev)
+            self.m_udev = None
+
+    def filenos(self) -> List[int]:
+        fds = list(self.devices)
+        if self.monitor is not None:
+            fds.append(self.monitor.fileno())
+        return fds
+
+    def finished(self) -> bool:
+        return self.given is not None and len(self.devices) == 0
+
+    def passthrough_capabilities(self) -> dict:
+        caps = {}
+        if len(self.passthrough_keys) != 0:
+            caps[EV_KEY] = sorted(self.passthrough_keys)
+        if len(self.passthrough_rels) != 0:
+            caps[EV_REL] = sorted(self.passthrough_rels)
+        return caps
+
+    def key_state(self) -> Optional[bytearray]:
+        # Keys held on any open device
+        state = bytearray(KEY_CNT // 8)
+        dev_state = bytearray(KEY_CNT // 8)
+        for fd in list(self.devices):
+            try:
+                fcntl.ioctl(fd, EVIOCGKEY(len(dev_state)), dev_state, True)
+            except OSError:
+                continue
+            for i, bits in enumerate(dev_state):
+                state[i] |= bits
+        return state
+
+    def lost_passthrough(self, state: Optional[bytearray]) -> List[int]:
+        forwarded = self.forwarded
+        lost = [code for code in range(KEY_CNT)
+                if forwarded[code] and (state is None or not has_bit(state, code))]
+        for code in lost:
+            forwarded[code] = 0
+        return lost
+
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        events = []
+        for fd in ready:
+            dev = self.devices.get(fd)
+            if dev is not None:
+                if not self.read_device(dev, events):
+                    self.remove_device(dev)
+                elif dev.grab_pending:
+                    self.try_grab(dev)
+            elif self.monitor is not None and fd == self.monitor.fileno():
+                for action, path in self.monitor.device_changes():
+                    if action == "add":
+                        self.add_device(path)
+                    elif path in self.paths:
+                        self.remove_device(self.paths[path])
+        return events
+
+    def read_device(self, dev: EvdevDevice, events: list) -> bool:
+        # Read and decode up to one buffer of events. False if the device is gone.
+        # Anything left is read on the next pass (poll reports the fd readable
+        # again), so one busy device can't delay the others, timers or output.
+        try:
+            n = os.readv(dev.fd, [dev.buf])
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        if n == 0:
+            return False
+        self.decode(dev, dev.view[:n - (n % INPUT_EVENT.size)], events)
+        return True
+
+    def forward_rel(self, code: int, value: int) -> bool:
+        # Pass a relative axis event of a grabbed device through
+        if code == REL_X or code == REL_Y:
+            return not self.consumed_motion
+        if code == REL_WHEEL or code == REL_WHEEL_HI_RES:
+            # Kernel wheel direction is opposite of libinput's
+            return not self.consumed_scroll[(ScrollAxis.VERTICAL << 1) | (value < 0)]
+        if code == REL_HWHEEL or code == REL_HWHEEL_HI_RES:
+            return not self.consumed_scroll[(ScrollAxis.HORIZONTAL << 1) | (value > 0)]
+        return True
+
+    def decode(self, dev: EvdevDevice, data: memoryview, events: list):
+        types = self.types
+        grab = dev.grabbed
+        forwarded = self.forwarded
+        for sec, usec, etype, code, value in INPUT_EVENT.iter_unpack(data):
+            if etype == EV_KEY:
+                # Autorepeat (value 2) is ignored (libinput does the same)
+                if value == 2 or dev.dropped:
+                    continue
+                if BTN_MISC <= code < KEY_OK:
+                    evtype = LibinputEventType.POINTER_BUTTON
+                else:
+                    evtype = LibinputEventType.KEYBOARD_KEY
+                if evtype in types:
+                    events.append((sec * 1000000 + usec, evtype, code, value))
+                if grab:
+                    if value != 0:
+                        forward = not self.consumed_keys[code]
+                        forwarded[code] = forward
+                    else:
+                        forward = forwarded[code]
+                        forwarded[code] = 0
+                    if forward:
+                        events.append((sec * 1000000 + usec, PASSTHROUGH | EV_KEY, code, value))
+                        dev.passthrough = True
+
+            elif etype == EV_REL:
+                if grab and not dev.dropped and self.forward_rel(code, value):
+                    events.append((sec * 1000000 + usec, PASSTHROUGH | EV_REL, code, value))
+                    dev.passthrough = True
+                if code == REL_X:
+                    dev.dx += value
+                elif code == REL_Y:
+                    dev.dy += value
+                elif code == REL_WHEEL_HI_RES:
+                    dev.wheel += value
+                elif code == REL_HWHEEL_HI_RES:
+                    dev.hwheel += value
+                elif code == REL_WHEEL and not dev.hires:
+                    dev.wheel += value * 120
+                elif code == REL_HWHEEL and not dev.hires:
+                    dev.hwheel += value * 120
+
+            elif etype == EV_SYN:
+                if code == SYN_REPORT and not dev.dropped:
+                    t = sec * 1000000 + usec
+                    if dev.passthrough:
+                        events.append((t, PASSTHROUGH | EV_SYN, SYN_REPORT, 0))
+                    if (dev.dx != 0 or dev.dy != 0) and LibinputEventType.POINTER_MOTION in types:
+                        events.append((t, LibinputEventType.POINTER_MOTION, 0, float(dev.dx)))
+                        events.append((t, LibinputEventType.POINTER_MOTION, 1, float(dev.dy)))
+                    if LibinputEventType.POINTER_SCROLL_WHEEL in types:
+                        # Same units and direction as libinput (15 per detent, positive = down / right)
+                        if dev.wheel != 0:
+                            events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, ScrollAxis.VERTICAL, dev.wheel * -0.125))
+                            events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, SCROLL_V120 | ScrollAxis.VERTICAL, float(-dev.wheel)))
+                        if dev.hwheel != 0:
+                            events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, ScrollAxis.HORIZONTAL, dev.hwheel * 0.125))
+                            events.append((t, LibinputEventType.POINTER_SCROLL_WHEEL, SCROLL_V120 | ScrollAxis.HORIZONTAL, float(dev.hwheel)))
+                elif code == SYN_DROPPED:
+                    # Kernel buffer overflowed (events were lost)
+                    dev.dropped = True
+                    self.dropped += 1
+                if code == SYN_REPORT or code == SYN_DROPPED:
+                    if code == SYN_REPORT:
+                        dev.dropped = False
+                    dev.dx = 0
+                    dev.dy = 0
+                    dev.wheel = 0
+                    dev.hwheel = 0
+                    dev.passthrough = False
+
+################################################################################
+
+
+
+################################################################################
+# Trace recording and replay
+################################################################################
+
+# Trace file format (little endian)
+#   Header: TRACE_MAGIC
+#   Records: TRACE_RECORD (time usec, type, code, value) repeated until EOF
+TRACE_MAGIC = b"LMTRACE1"
+TRACE_RECORD = struct.Struct("<qHHd")
+
+class TraceRecorder(WrappedBackend):
+    # Wraps another backend and writes every event it returns to a trace file
+
+    def __init__(self, backend: InputBackend, path: str):
+        super().__init__(backend)
+        self.path = path
+        self.file = None
+
+    def open(self, lm: "LibMacro"):
+        self.file = open(self.path, "wb")
+        self.file.write(TRACE_MAGIC)
+        self.backend.open(lm)
+
+    def close(self):
+        self.backend.close()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        events = self.backend.read_events(deadline, ready)
+        if len(events) != 0:
+            self.file.write(b"".join(TRACE_RECORD.pack(*ev) for ev in events))
+        return events
+
+
+def load_trace(path: str) -> List[tuple]:
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+        raise Exception("{} is not a libmacro trace file".format(path))
+    data = memoryview(data)[len(TRACE_MAGIC):]
+    usable = len(data) - (len(data) % TRACE_RECORD.size)      # Ignore truncated last record
+    return list(TRACE_RECORD.iter_unpack(data[:usable]))
+
+
+class TraceReplayBackend(InputBackend):
+    # Replays events from a trace file (or a list of event tuples)
+    # realtime = True:  Events are returned at the recorded times (relative to
+    #                   when replay started). Timers use the real clock.
+    # realtime = False: Events are returned as fast as possible. Timers use a
+    #                   virtual clock that follows the recorded event times,
+    #                   so results are the same on every run.
+
+    def __init__(self, trace, realtime: bool = True):
+        if isinstance(trace, str):
+            trace = load_trace(trace)
+        self.events = trace
+        self.realtime = realtime
+        self.index = 0
+        self.start = 0.0
+        self.now = 0.0
+
+    def open(self, lm: "LibMacro"):
+        self.index = 0
+        self.start = time.monotonic()
+        self.now = self.events[0][0] / 1e6 if len(self.events) != 0 else 0.0
+
+    def event_time(self, i: int) -> float:
+        # Time (in clock() units) at which event i should be returned
+        if self.realtime:
+            return self.start + (self.events[i][0] - self.events[0][0]) / 1e6
+        return self.events[i][0] / 1e6
+
+    def poll_timeout(self) -> int:
+        if self.index >= len(self.events):
+            return -1
+        if not self.realtime:
+            return 0
+        return max(0, math.ceil((self.event_time(self.index) - time.monotonic()) * 1000))
+
+    def clock(self) -> float:
+        if self.realtime:
+            return time.monotonic()
+        return self.now
+
+    def monotonic_clock(self) -> bool:
+        return self.realtime
+
+    def finished(self) -> bool:
+        return self.index >= len(self.events)
+
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        if self.index >= len(self.events):
+            if not self.realtime and deadline is not None:
+                self.now = max(self.now, deadline)
+            return []
+
+        if self.realtime:
+            now = time.monotonic()
+        else:
+            # Jump the virtual clock to the next event (or the next timer if it is first)
+            now = self.event_time(self.index)
+            if deadline is not None and deadline < now:
+                self.now = max(self.now, deadline)
+                return []
+            self.now = now
+
+        start = self.index
+        end = start
+        while end < len(self.events) and self.event_time(end) <= now:
+            end += 1
+        self.index = end
+        return self.events[start:end]
+
+################################################################################
+
+
+
+################################################################################
+# Reader thread
+################################################################################
+
+# Default ThreadedBackend queue size (events, power of 2)
+READER_QUEUE_SIZE = 4096
+
+class ThreadedBackend(WrappedBackend):
+    # Reads another backend on a dedicated thread so slow handlers can't let
+    # the kernel / libinput buffers overflow. Events are stored in a bounded,
+    # preallocated queue of compact records (parallel arrays) and the reader
+    # writes to a pipe to wake the event loop.
+    #
+    # The queue has one producer (reader thread) and one consumer (event
+    # loop). head is only changed by the reader, tail only by the consumer.
+    # When the queue is full events are dropped and counted (dropped), so
+    # LibMacro resyncs the key state once everything queued before the loss
+    # has been handled.
+    #
+    # Only for backends using the real clock (not replay at maximum speed).
+
+    # The reader thread handles the wrapped backend's fds_changed and dropped,
+    # so these are this backend's own (not forwarded)
+    fds_changed = False
+    dropped = 0
+
+    def __init__(self, backend: InputBackend, size: int = READER_QUEUE_SIZE):
+        super().__init__(backend)
+        self.size = size
+        self.mask = size - 1
+        self.times = array("q", bytes(8 * size))
+        self.evtypes = array("H", bytes(2 * size))
+        self.codes = array("H", bytes(2 * size))
+        self.values = array("d", bytes(8 * size))
+        self.head = 0
+        self.tail = 0
+
+        # Events lost (queue full or lost by the wrapped backend). Set by the
+        # reader. dropped is set from it by the consumer.
+        self.lost = 0
+        self.backend_dropped = 0
+        self.dropped = 0
+
+        self.thread = None
+        self.error = None
+        self.reader_done = False
+        self.wake_r = -1
+        self.wake_w = -1
+        self.stop_r = -1
+        self.stop_w = -1
+
+    def open(self, lm: "LibMacro"):
+        import threading
+        self.backend.open(lm)
+        self.wake_r, self.wake_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.stop_r, self.stop_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.thread = threading.Thread(target=self.reader, name="libmacro-reader", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            os.write(self.stop_w, b"\0")
+            self.thread.join()
+            self.thread = None
+        for fd in (self.wake_r, self.wake_w, self.stop_r, self.stop_w):
+            if fd >= 0:
+                os.close(fd)
+        self.wake_r = self.wake_w = self.stop_r = self.stop_w = -1
+        self.backend.close()
+
+    def filenos(self) -> List[int]:
+        return [self.wake_r]
+
+    def poll_timeout(self) -> int:
+        return -1
+
+    def finished(self) -> bool:
+        return self.reader_done and self.tail == self.head
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, b"\0")
+        except BlockingIOError:
+            # Pipe full, so the event loop will wake anyway
+            pass
+
+    def reader(self):
+        backend = self.backend
+        poll = select.poll()
+        registered = set(backend.filenos())
+        for fd in registered:
+            poll.register(fd, select.POLLIN)
+        poll.register(self.stop_r, select.POLLIN)
+        try:
+            while not backend.finished():
+                ready = [fd for fd, _ in poll.poll(backend.poll_timeout())]
+                if self.stop_r in ready:
+                    break
+                events = backend.read_events(None, ready)
+                if len(events) != 0:
+                    self.push(events)
+                if backend.dropped != self.backend_dropped:
+                    # Lost by the wrapped backend. Consumer resyncs.
+                    self.lost += backend.dropped - self.backend_dropped
+                    self.backend_dropped = backend.dropped
+                    self.wake()
+                if backend.fds_changed:
+                    backend.fds_changed = False
+                    fds = set(backend.filenos())
+                    for fd in registered - fds:
+                        poll.unregister(fd)
+                    for fd in fds - registered:
+                        poll.register(fd, select.POLLIN)
+                    registered = fds
+        except BaseException as e:
+            # Raised from read_events on the event loop thread
+            self.error = e
+        self.reader_done = True
+        self.wake()
+
+    def push(self, events: List[tuple]):
+        head = self.head
+        mask = self.mask
+        free = self.size - (head - self.tail)
+        lost = max(0, len(events) - free)
+        if lost != 0:
+            events = events[:free]
+        for t, evtype, code, value in events:
+            slot = head & mask
+            self.times[slot] = t
+            self.evtypes[slot] = evtype
+            self.codes[slot] = code
+            self.values[slot] = value
+            head += 1
+        # Events kept are published before the loss, so the consumer never
+        # sees a loss without everything queued before it
+        self.head = head
+        self.lost += lost
+        self.wake()
+
+    def read_events(self, deadline: Optional[float], ready: List[int]) -> List[tuple]:
+        try:
+            while len(os.read(self.wake_r, 4096)) == 4096:
+                pass
+        except BlockingIOError:
+            pass
+
+        # Lost count must be read before the events (the reader publishes
+        # them before the loss) so every event queued before a loss is handled
+        # before LibMacro resyncs
+        lost = self.lost
+        head = self.head
+        tail = self.tail
+        mask = self.mask
+        events = []
+        while tail != head:
+            slot = tail & mask
+            events.append((self.times[slot], self.evtypes[slot], self.codes[slot], self.values[slot]))
+            tail += 1
+        self.tail = tail
+        self.dropped = lost
+
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+        return events
 
 ################################################################################
-# libinput support
+
+
+
+################################################################################
+# Macros
 ################################################################################
 
-CFUNC_OPEN_RESTRICTED = ctypes.CFUNCTYPE( ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p)
-CFUNC_CLOSE_RESTRICTED = ctypes.CFUNCTYPE(None,  ctypes.c_int,  ctypes.c_void_p)
+# A Macro is a recording of input events ready to be played back through the
+# uinput device: (time, type, code, value) with time in microseconds since
+# the first event (from the kernel timestamps, not when handlers ran) and
+# type / code / value as uinput events (EV_KEY, EV_REL). Stored as one array
+# per field, so it is compact and saved / loaded in bulk.
+#
+# Macro file format (little endian)
+#   MACRO_MAGIC, then MACRO_HEADER (number of events), then the time (int64),
+#   type (uint16), code (uint16) and value (int32) arrays one after another
+MACRO_MAGIC = b"LMMACRO1"
+MACRO_HEADER = struct.Struct("<I")
 
-class libinput_interface(ctypes.Structure):
-    _fields_ = [
-        ("open_restricted", CFUNC_OPEN_RESTRICTED),
-        ("close_restricted",  CFUNC_CLOSE_RESTRICTED)
-    ]
+class Macro:
 
-def libinput_open_restricted(path, flags, user_data):
-    return os.open(path, flags)
+    def __init__(self):
+        self.times = array("q")
+        self.types = array("H")
+        self.codes = array("H")
+        self.values = array("i")
 
-def libinput_close_restricted(fd, user_data):
-    os.close(fd)
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def append(self, time: int, etype: int, code: int, value: int):
+        self.times.append(time)
+        self.types.append(etype)
+        self.codes.append(code)
+        self.values.append(value)
+
+    def duration(self) -> float:
+        # Seconds from the first to the last event
+        return self.times[-1] / 1000000 if len(self.times) != 0 else 0.0
 
-libinput = ctypes.CDLL("libinput.so")
+    def codes_used(self, etype: int) -> List[int]:
+        # Codes of the given type in the macro (eg for key_events_generated)
+        return sorted({code for t, code in zip(self.types, self.codes) if t == etype})
 
-libinput.libinput_udev_create_context.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
-libinput.libinput_udev_create_context.restype = ctypes.c_void_p
+    def columns(self) -> List[array]:
+        return [self.times, self.types, self.codes, self.values]
 
-libinput.libinput_udev_assign_seat.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
-libinput.libinput_udev_assign_seat.restype = ctypes.c_int
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(MACRO_MAGIC)
+            f.write(MACRO_HEADER.pack(len(self)))
+            for column in self.columns():
+                if sys.byteorder != "little":
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                column.tofile(f)
 
-libinput.libinput_unref.argtypes = [ctypes.c_void_p]
-libinput.libinput_unref.restype = ctypes.c_void_p
+    @staticmethod
+    def load(path: str) -> "Macro":
+        macro = Macro()
+        with open(path, "rb") as f:
+            if f.read(len(MACRO_MAGIC)) != MACRO_MAGIC:
+                raise Exception("{} is not a libmacro macro file".format(path))
+            count, = MACRO_HEADER.unpack(f.read(MACRO_HEADER.size))
+            for column in macro.columns():
+                column.fromfile(f, count)
+                if sys.byteorder != "little":
+                    column.byteswap()
+        return macro
 
-libinput.libinput_dispatch.argtypes = [ctypes.c_void_p]
-libinput.libinput_dispatch.restype = ctypes.c_int
 
-libinput.libinput_get_event.argtypes = [ctypes.c_void_p]
-libinput.libinput_get_event.restype = ctypes.c_void_p
+class MacroRecorder:
+    # Records input events into a Macro. LibMacro passes each event to
+    # running recorders once it has been dispatched.
+    #
+    # Only event types the scripts handle are read from the devices (set
+    # track_input_state to get all keys and buttons and track_scroll to get
+    # the wheel, subscribe to motion to record it). Keys in exclude (eg the
+    # hotkey starting / stopping recording) are not recorded. Scrolling is
+    # recorded in whole wheel detents (hi-res remainders are carried over).
 
-libinput.libinput_event_get_type.argtypes = [ctypes.c_void_p]
-libinput.libinput_event_get_type.restype = ctypes.c_int
+    def __init__(self, lm: "LibMacro", exclude: List[int] = ()):
+        self.lm = lm
+        self.exclude = set(exclude)
+        self.macro = Macro()
+        self.start_time = None
+        self.wheel = 0.0
+        self.hwheel = 0.0
+        self.dx = 0.0
+        self.dy = 0.0
 
-libinput.libinput_event_get_pointer_event.argtypes = [ctypes.c_void_p]
-libinput.libinput_event_get_pointer_event.restype = ctypes.c_void_p
+    def start(self):
+        if self not in self.lm.recorders:
+            self.lm.recorders.append(self)
 
-libinput.libinput_event_pointer_get_button.argtypes = [ctypes.c_void_p]
-libinput.libinput_event_pointer_get_button.restype = ctypes.c_uint32
+    def stop(self) -> Macro:
+        if self in self.lm.recorders:
+            self.lm.recorders.remove(self)
+        return self.macro
 
-libinput.libinput_event_pointer_get_button_state.argtypes = [ctypes.c_void_p]
-libinput.libinput_event_pointer_get_button_state.restype = ctypes.c_int
+    def append(self, t: int, etype: int, code: int, value: int):
+        # Times are relative to the first recorded event (not the first one
+        # seen, which may be excluded, eg the key that started recording)
+        if self.start_time is None:
+            self.start_time = t
+        self.macro.append(t - self.start_time, etype, code, value)
 
-libinput.libinput_event_pointer_has_axis.argtypes = [ctypes.c_void_p, ctypes.c_int]
-libinput.libinput_event_pointer_has_axis.restype = ctypes.c_int
+    def record(self, event: tuple):
+        t, evtype, code, value = event
+        if evtype == LibinputEventType.KEYBOARD_KEY or evtype == LibinputEventType.POINTER_BUTTON:
+            if code not in self.exclude:
+                self.append(t, EV_KEY, code, 1 if value else 0)
+        elif evtype == LibinputEventType.POINTER_SCROLL_WHEEL:
+            # uinput wheel direction is opposite of libinput's (vertical only)
+            if code == SCROLL_V120 | ScrollAxis.VERTICAL:
+                self.wheel += value
+                detents = int(self.wheel / 120)
+                if detents != 0:
+                    self.wheel -= detents * 120
+                    self.append(t, EV_REL, REL_WHEEL, -detents)
+            elif code == SCROLL_V120 | ScrollAxis.HORIZONTAL:
+                self.hwheel += value
+                detents = int(self.hwheel / 120)
+                if detents != 0:
+                    self.hwheel -= detents * 120
+                    self.append(t, EV_REL, REL_HWHEEL, detents)
+        elif evtype == LibinputEventType.POINTER_MOTION:
+            if code == 0:
+                self.dx += value
+                move = int(self.dx)
+                if move != 0:
+                    self.dx -= move
+                    self.append(t, EV_REL, REL_X, move)
+            else:
+                self.dy += value
+                move = int(self.dy)
+                if move != 0:
+                    self.dy -= move
+                    self.append(t, EV_REL, REL_Y, move)
 
-libinput.libinput_event_pointer_get_scroll_value.argtypes = [ctypes.c_void_p, ctypes.c_int]
-libinput.libinput_event_pointer_get_scroll_value.restype = ctypes.c_double
 
-libinput.libinput_event_get_keyboard_event.argtypes = [ctypes.c_void_p]
-libinput.libinput_event_get_keyboard_event.restype = ctypes.c_void_p
+class MacroPlayer:
+    # Plays a Macro through the uinput device from the event loop. Each event
+    # has an absolute deadline (start + recorded time / speed), so timer
+    # lateness never adds up over the macro. Events recorded with the same
+    # time are sent as one frame. Input is handled normally while playing.
+    #
+    # errors holds how late each event was sent (ns). Keys the macro still
+    # holds when it ends or is stopped are released. on_done(player) is
+    # called when done.
 
-libinput.libinput_event_keyboard_get_key.argtypes = [ctypes.c_void_p]
-libinput.libinput_event_keyboard_get_key.restype = ctypes.c_uint32
+    def __init__(self, lm: "LibMacro", macro: Macro, speed: float = 1.0, on_done: Optional[Callable] = None):
+        self.lm = lm
+        self.macro = macro
+        self.speed = speed
+        self.on_done = on_done
+        self.start_time = 0.0
+        self.index = 0
+        self.timer = None
+        self.held = set()
+        self.errors = array("q", bytes(8 * len(macro)))
 
-libinput.libinput_event_keyboard_get_key_state.argtypes = [ctypes.c_void_p]
-libinput.libinput_event_keyboard_get_key_state.restype = ctypes.c_int
+    def playing(self) -> bool:
+        return self.timer is not None
 
-libinput.libinput_event_destroy.argtypes = [ctypes.c_void_p]
-libinput.libinput_event_destroy.restype = None
+    def deadline(self, index: int) -> float:
+        return self.start_time + self.macro.times[index] / 1000000 / self.speed
 
-libinput.libinput_get_fd.argtypes = [ctypes.c_void_p]
-libinput.libinput_get_fd.restype = ctypes.c_int
+    def start(self):
+        self.stop()
+        self.index = 0
+        self.start_time = self.lm.clock()
+        if len(self.macro) != 0:
+            self.timer = self.lm.schedule_at(self.deadline(0), self.play)
 
-libinput.libinput_event_get_device.argtypes = [ctypes.c_void_p]
-libinput.libinput_event_get_device.restype = ctypes.c_void_p
+    def play(self):
+        macro = self.macro
+        ui = self.lm.ui
+        now = self.lm.clock()
+        index = self.index
+        while index < len(macro) and self.deadline(index) <= now:
+            # One frame per recorded time
+            t = macro.times[index]
+            ui.begin_frame()
+            while index < len(macro) and macro.times[index] == t:
+                etype = macro.types[index]
+                code = macro.codes[index]
+                value = macro.values[index]
+                ui.write(etype, code, value)
+                if etype == EV_KEY:
+                    if value != 0:
+                        self.held.add(code)
+                    else:
+                        self.held.discard(code)
+                self.errors[index] = int((now - self.deadline(index)) * 1e9)
+                index += 1
+            ui.end_frame()
+        self.index = index
 
-libinput.libinput_device_get_name.argtypes = [ctypes.c_void_p]
-libinput.libinput_device_get_name.restype = ctypes.c_char_p
+        if index < len(macro):
+            self.timer = self.lm.schedule_at(self.deadline(index), self.play)
+        else:
+            self.timer = None
+            self.release_held()
+            log.info("Macro played: {}", self.report())
+            if self.on_done is not None:
+                self.on_done(self)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.release_held()
+
+    def release_held(self):
+        # Release keys still held by the macro (one frame)
+        if len(self.held) != 0:
+            with self.lm.ui.frame():
+                for code in self.held:
+                    self.lm.ui.write(EV_KEY, code, 0)
+            self.held.clear()
+
+    def report(self) -> str:
+        # Timing error of the events sent so far
+        errors = sorted(self.errors[:self.index])
+        if len(errors) == 0:
+            return "no events sent"
+        return "{} events, timing error mean {:.1f} us, p50 {:.1f} us, p99 {:.1f} us, max {:.1f} us".format(
+            len(errors), sum(errors) / len(errors) / 1000, errors[len(errors) // 2] / 1000,
+            errors[min(len(errors) - 1, int(len(errors) * 0.99))] / 1000, errors[-1] / 1000)
 
 ################################################################################
 
 
 
 ################################################################################
-# libudev support
+# Event subscriptions
+################################################################################
+
+# Script methods are subscribed to events using these decorators. LibMacro
+# compiles the subscriptions into lookup tables when it starts, so events no
+# handler is subscribed to are dropped without calling into the script.
+#
+# Handlers are called with the same arguments as the matching LibMacroScript
+# handle_* method. Example:
+#
+#   @on_key(ecodes.KEY_LEFTCTRL, ecodes.KEY_RIGHTCTRL, pressed=True)
+#   def ctrl_pressed(self, keycode: int, pressed: bool):
+#       ...
+#
+# Scripts that override handle_key / handle_mouse_button / handle_mouse_scroll
+# receive every event of that type (same as before subscriptions existed).
+#
+# on_scroll_burst handlers are instead called with a ScrollBurst (see Scroll
+# stage) holding every scroll event of a burst added together. on_motion
+# handlers are called with a MotionBatch (see Motion stage). on_chord and
+# on_sequence handlers are called by the key matchers (see Chords and
+# sequences).
+
+def subscribe(evtype: int, codes: List[int], states: List[int]) -> Callable:
+    def decorator(fn: Callable) -> Callable:
+        if not hasattr(fn, "libmacro_subscriptions"):
+            fn.libmacro_subscriptions = []
+        fn.libmacro_subscriptions.append((evtype, list(codes), list(states)))
+        return fn
+    return decorator
+
+def states_for(pressed: Optional[bool]) -> List[int]:
+    if pressed is None:
+        return [0, 1]
+    return [1] if pressed else [0]
+
+def on_key(*keys: int, pressed: Optional[bool] = None) -> Callable:
+    # keys: Key codes (none = all keys). pressed: Only presses / releases (None = both)
+    return subscribe(LibinputEventType.KEYBOARD_KEY, keys if len(keys) != 0 else range(KEY_CNT), states_for(pressed))
+
+def on_button(*buttons: int, pressed: Optional[bool] = None) -> Callable:
+    # buttons: Button codes (none = all buttons). pressed: Only presses / releases (None = both)
+    return subscribe(LibinputEventType.POINTER_BUTTON, buttons if len(buttons) != 0 else range(KEY_CNT), states_for(pressed))
+
+def on_scroll(vertical: Optional[bool] = None) -> Callable:
+    # vertical: Only vertical (True) / horizontal (False) scrolling (None = both)
+    if vertical is None:
+        axes = [ScrollAxis.VERTICAL, ScrollAxis.HORIZONTAL]
+    else:
+        axes = [ScrollAxis.VERTICAL] if vertical else [ScrollAxis.HORIZONTAL]
+    # State for scroll events is the direction (1 = positive distance)
+    return subscribe(LibinputEventType.POINTER_SCROLL_WHEEL, axes, [0, 1])
+
+def on_chord(*keys: Any, pressed: bool = True) -> Callable:
+    # keys: Keys / buttons that must all be held. A tuple means any one of
+    # its keys (eg (KEY_LEFTCTRL, KEY_RIGHTCTRL)). Other keys may also be held.
+    # pressed: Call when the chord becomes held (True) or is no longer held
+    # after being held (False). Handlers are called as handler(pressed).
+    def decorator(fn: Callable) -> Callable:
+        if not hasattr(fn, "libmacro_chords"):
+            fn.libmacro_chords = []
+        elements = tuple(tuple(key) if isinstance(key, (tuple, list)) else (key,) for key in keys)
+        fn.libmacro_chords.append((elements, pressed))
+        return fn
+    return decorator
+
+def on_sequence(*keys: int, timeout: float = 1.0) -> Callable:
+    # keys: Keys / buttons pressed one after another (releases don't matter)
+    # timeout: Most seconds between two presses of the sequence
+    # Handlers are called with no arguments when the last key is pressed.
+    def decorator(fn: Callable) -> Callable:
+        if not hasattr(fn, "libmacro_sequences"):
+            fn.libmacro_sequences = []
+        fn.libmacro_sequences.append((tuple(keys), timeout))
+        return fn
+    return decorator
+
+def on_scroll_burst(window: float = 0.0) -> Callable:
+    # window: Seconds a burst stays open after its first event (0 = until all
+    # events available at once have been handled)
+    def decorator(fn: Callable) -> Callable:
+        fn.libmacro_scroll_burst = window
+        return fn
+    return decorator
+
+def on_motion(output: bool = False) -> Callable:
+    # Handlers are called as handler(batch) once per MotionBatch and may change
+    # its motion in place. output: Send the (changed) motion of each batch
+    # through the uinput device. Only use it when the mouse's own motion does
+    # not also reach the desktop (evdev backend with --grab, which passes the
+    # mouse's buttons and wheel through unless a script consumes them).
+    # Otherwise the pointer moves twice.
+    def decorator(fn: Callable) -> Callable:
+        fn.libmacro_motion = output
+        return fn
+    return decorator
+
+
+class DispatchTable:
+    # Handlers for one event type. Dense list indexed by (code << 1) | state
+    # holding a tuple of handlers (or None if nothing is subscribed).
+
+    def __init__(self, size: int):
+        self.entries = [None] * (size * 2)
+
+    def add(self, codes: List[int], states: List[int], handler: Callable):
+        for code in codes:
+            for state in states:
+                index = (code << 1) | state
+                if self.entries[index] is None:
+                    self.entries[index] = (handler,)
+                elif handler not in self.entries[index]:
+                    self.entries[index] = self.entries[index] + (handler,)
+
+################################################################################
+
+
+
+################################################################################
+# Scroll stage
+################################################################################
+
+# Hi-res and free spinning wheels send a flood of small scroll events. A
+# ScrollStage adds them together so on_scroll_burst handlers are called once
+# per burst instead of once per event.
+#
+# A burst ends when the events available at once have been handled (window 0)
+# or window seconds after it started. A burst never changes direction: a
+# scroll in the opposite direction on the same axis ends it and starts a new
+# one, so checking the direction once per burst sees every change.
+
+class ScrollBurst:
+    # Scroll events added together. Distances are in libinput units (15 per
+    # detent, positive = down / right). v120 distances have the same sign.
+
+    def __init__(self, time: int):
+        self.start_time = time      # First and last event time (microseconds)
+        self.end_time = time
+        self.events = 0             # Number of axis events added together
+        self.vertical = 0.0
+        self.horizontal = 0.0
+        self.vertical_v120 = 0.0
+        self.horizontal_v120 = 0.0
+
+
+class ScrollStage:
+    # Builds ScrollBursts for the on_scroll_burst handlers using one window
+
+    def __init__(self, lm: "LibMacro", window: float):
+        self.lm = lm
+        self.window = window
+        self.handlers = []
+        self.burst = None
+        self.timer = None
+
+    def add(self, event: tuple):
+        t, _, code, value = event
+        burst = self.burst
+        if code == ScrollAxis.VERTICAL:
+            if burst is not None and burst.vertical * value < 0.0:
+                self.flush()
+                burst = None
+            if burst is None:
+                burst = self.start(t)
+            burst.vertical += value
+        elif code == ScrollAxis.HORIZONTAL:
+            if burst is not None and burst.horizontal * value < 0.0:
+                self.flush()
+                burst = None
+            if burst is None:
+                burst = self.start(t)
+            burst.horizontal += value
+        elif burst is not None:
+            # v120 value for the axis event just added
+            if code == SCROLL_V120 | ScrollAxis.VERTICAL:
+                burst.vertical_v120 += value
+            else:
+                burst.horizontal_v120 += value
+            return
+        else:
+            return
+        burst.events += 1
+        burst.end_time = t
+
+    def start(self, t: int) -> ScrollBurst:
+        self.burst = ScrollBurst(t)
+        if self.window > 0.0:
+            self.timer = self.lm.schedule(self.window, self.flush)
+        return self.burst
+
+    def flush(self):
+        # End the current burst (if any) and pass it to the handlers
+        burst = self.burst
+        if burst is None:
+            return
+        self.burst = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.lm.call_handlers(self.handlers, (burst,))
+
+################################################################################
+
+
+
+################################################################################
+# Motion stage
+################################################################################
+
+# High polling rate mice send 1000+ motion events per second. Instead of a
+# handler call (and uinput write) per event, the motion events handled at
+# once are collected into a MotionBatch (preallocated arrays) and the
+# on_motion handlers are called once for the whole batch. Handlers change
+# the batch in place (eg apply a MotionCurve, scale or lock an axis), then
+# the stage sends the sum as one REL_X / REL_Y frame. Fractions of a count
+# are carried over to the next batch so slow movement is not lost.
+#
+# When NumPy is available dx, dy, dt and times are NumPy arrays (views of the
+# same memory) and curves are applied to a batch with a few array operations.
+# Otherwise they are array.array and curves are applied in a loop. The loop
+# is also used for small batches (NumPy has a fixed cost of ~15 us per batch).
+
+# Events per batch. A drain with more motion is split into several batches.
+MOTION_BATCH_SIZE = 1024
+
+# Time assumed since the previous movement for the first one after idle (us)
+MOTION_IDLE_DT = 1000.0
+
+# Smallest batch processed with NumPy
+MOTION_NUMPY_MIN_BATCH = 16
+
+class MotionCurve:
+    # Gain (output / input distance) by speed in counts per millisecond, as a
+    # lookup table with one entry per step of speed. Either sample a gain
+    # function (gain(speed) for speeds 0 to max_speed) or give the table.
+    # Faster movement uses the last entry.
+
+    def __init__(self, gain: Optional[Callable] = None, table: Optional[List[float]] = None,
+                 step: float = 0.1, max_speed: float = 50.0):
+        if table is None:
+            if gain is None:
+                raise Exception("MotionCurve needs a gain function or a table.")
+            table = [gain(i * step) for i in range(int(max_speed / step) + 1)]
+        if len(table) == 0:
+            raise Exception("MotionCurve table is empty.")
+        self.table = array("d", table)
+        self.scale = 1.0 / step
+        self.np_table = None
+
+
+class MotionBatch:
+    # Motion events collected by the motion stage. Only the first count
+    # entries are valid. dt is the time since the previous movement (us).
+
+    def __init__(self, size: int, numpy):
+        self.numpy = numpy
+        self.count = 0
+        self.buffers = (array("q", bytes(8 * size)), array("d", bytes(8 * size)),
+                        array("d", bytes(8 * size)), array("d", bytes(8 * size)))
+        if numpy is not None:
+            self.times, self.dt, self.dx, self.dy = (numpy.frombuffer(b, dtype=b.typecode) for b in self.buffers)
+        else:
+            self.times, self.dt, self.dx, self.dy = self.buffers
+
+    def total(self) -> tuple:
+        # Sum of the motion in the batch (dx, dy)
+        n = self.count
+        if self.numpy is not None and n >= MOTION_NUMPY_MIN_BATCH:
+            return float(self.dx[:n].sum()), float(self.dy[:n].sum())
+        _, _, dx, dy = self.buffers
+        return math.fsum(dx[:n]), math.fsum(dy[:n])
+
+    def scale(self, x: float, y: float):
+        # Multiply each axis (eg 0 to lock an axis)
+        n = self.count
+        if self.numpy is not None and n >= MOTION_NUMPY_MIN_BATCH:
+            self.dx[:n] *= x
+            self.dy[:n] *= y
+            return
+        _, _, dx, dy = self.buffers
+        for i in range(n):
+            dx[i] *= x
+            dy[i] *= y
+
+    def apply(self, curve: MotionCurve):
+        # Multiply each movement by the curve's gain at its speed
+        n = self.count
+        last = len(curve.table) - 1
+        k = curve.scale * 1000.0
+        numpy = self.numpy
+        if numpy is not None and n >= MOTION_NUMPY_MIN_BATCH:
+            if curve.np_table is None:
+                curve.np_table = numpy.frombuffer(curve.table, dtype="d")
+            dx = self.dx[:n]
+            dy = self.dy[:n]
+            index = numpy.hypot(dx, dy) * k / self.dt[:n]
+            numpy.minimum(index, last, out=index)
+            gain = curve.np_table[index.astype(numpy.intp)]
+            dx *= gain
+            dy *= gain
+            return
+        table = curve.table
+        _, dt, dx, dy = self.buffers
+        hypot = math.hypot
+        for i in range(n):
+            x = dx[i]
+            y = dy[i]
+            index = hypot(x, y) * k / dt[i]
+            gain = table[int(index)] if index < last else table[last]
+            dx[i] = x * gain
+            dy[i] = y * gain
+
+
+class MotionStage:
+    # Builds MotionBatches for the on_motion handlers and sends their motion
+
+    def __init__(self, lm: "LibMacro", size: int = MOTION_BATCH_SIZE):
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        self.lm = lm
+        self.handlers = []
+        self.output = False
+        self.batch = MotionBatch(size, numpy)
+        self.size = size
+        self.last_time = None
+        self.remainder_x = 0.0
+        self.remainder_y = 0.0
+
+    def add(self, t: int, code: int, value: float):
+        # Written through the array.array buffers (faster per item than NumPy)
+        batch = self.batch
+        times, dt, dx, dy = batch.buffers
+        n = batch.count
+        if code != 0 and n != 0 and times[n - 1] == t:
+            # y of the movement whose x was just added
+            dy[n - 1] += value
+            return
+        if n == self.size:
+            self.flush()
+            n = 0
+        times[n] = t
+        dt[n] = max(1.0, t - self.last_time) if self.last_time is not None else MOTION_IDLE_DT
+        dx[n] = value if code == 0 else 0.0
+        dy[n] = value if code != 0 else 0.0
+        batch.count = n + 1
+        self.last_time = t
+
+    def flush(self):
+        # Pass the batch (if any motion) to the handlers and send the result
+        batch = self.batch
+        if batch.count == 0:
+            return
+        self.lm.call_handlers(self.handlers, (batch,))
+        if self.output:
+            x, y = batch.total()
+            x += self.remainder_x
+            y += self.remainder_y
+            move_x = int(x)
+            move_y = int(y)
+            self.remainder_x = x - move_x
+            self.remainder_y = y - move_y
+            if move_x != 0 or move_y != 0:
+                ui = self.lm.ui
+                with ui.frame():
+                    if move_x != 0:
+                        ui.write(EV_REL, REL_X, move_x)
+                    if move_y != 0:
+                        ui.write(EV_REL, REL_Y, move_y)
+        batch.count = 0
+
+################################################################################
+
+
+
+################################################################################
+# Chords and sequences
+################################################################################
+
+# LibMacro keeps which keys and buttons are held (LibMacro.pressed, one byte
+# per code) and passes every key / button event to the key matchers. The
+# matchers are compiled once when LibMacro starts so each event only costs
+# the chords using that key and one table lookup per sequence timeout, no
+# matter how many chords and sequences are registered.
+
+class ChordMatcher:
+    # Each key has a list of the chord elements it is part of. Each element
+    # remembers if it is held, each chord how many of its elements are held.
+
+    def __init__(self, lm: "LibMacro"):
+        self.lm = lm
+        self.chords = {}                # elements: chord index
+        self.sizes = []
+        self.held_elements = []         # Per chord
+        self.press_handlers = []        # Per chord
+        self.release_handlers = []      # Per chord
+        self.element_held = []          # Per chord, per element (bytearray)
+        self.by_code = [None] * KEY_CNT # code: tuple of (chord, element, keys)
+
+    def add(self, elements: tuple, pressed: bool, handler: Callable):
+        chord = self.chords.get(elements)
+        if chord is None:
+            chord = len(self.sizes)
+            self.chords[elements] = chord
+            self.sizes.append(len(elements))
+            self.held_elements.append(0)
+            self.press_handlers.append([])
+            self.release_handlers.append([])
+            self.element_held.append(bytearray(len(elements)))
+            for element, keys in enumerate(elements):
+                for code in keys:
+                    entry = (chord, element, keys)
+                    self.by_code[code] = (self.by_code[code] or ()) + (entry,)
+        handlers = self.press_handlers[chord] if pressed else self.release_handlers[chord]
+        handlers.append(handler)
+
+    def codes(self) -> List[int]:
+        return [code for code, entries in enumerate(self.by_code) if entries is not None]
+
+    def handlers(self) -> List[Callable]:
+        return [h for handlers in self.press_handlers + self.release_handlers for h in handlers]
+
+    def key(self, t: int, code: int, state: bool):
+        entries = self.by_code[code]
+        if entries is None:
+            return
+        pressed = self.lm.pressed
+        for chord, element, keys in entries:
+            held = False
+            for key in keys:
+                if pressed[key]:
+                    held = True
+                    break
+            element_held = self.element_held[chord]
+            if held == element_held[element]:
+                continue
+            element_held[element] = held
+            if held:
+                self.held_elements[chord] += 1
+                if self.held_elements[chord] == self.sizes[chord]:
+                    self.lm.call_handlers(self.press_handlers[chord], (True,))
+            else:
+                if self.held_elements[chord] == self.sizes[chord]:
+                    self.lm.call_handlers(self.release_handlers[chord], (False,))
+                self.held_elements[chord] -= 1
+
+
+class SequenceMatcher:
+    # Aho-Corasick automaton over key presses for all sequences using one
+    # timeout. The automaton is compiled into a transition table (state:
+    # {code: next state}, missing = start state), so each press is one lookup.
+    # Too long between presses goes back to the start state.
+
+    def __init__(self, lm: "LibMacro", timeout: float):
+        self.lm = lm
+        self.timeout = int(timeout * 1000000)
+        self.goto = [{}]                # Trie
+        self.outputs = [[]]             # Handlers of sequences ending at each state
+        self.table = None
+        self.state = 0
+        self.last_time = 0
+
+    def add(self, keys: tuple, handler: Callable):
+        state = 0
+        for code in keys:
+            next_state = self.goto[state].get(code)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][code] = next_state
+                self.goto.append({})
+                self.outputs.append([])
+            state = next_state
+        self.outputs[state].append(handler)
+
+    def codes(self) -> List[int]:
+        return list({code for goto in self.goto for code in goto})
+
+    def handlers(self) -> List[Callable]:
+        return [h for handlers in self.outputs for h in handlers]
+
+    def compile(self):
+        # Breadth first, so the failure state (always closer to the start) of
+        # each state is done before it. Every state gets the transitions of
+        # its failure state that it doesn't have itself.
+        fail = [0] * len(self.goto)
+        table = [None] * len(self.goto)
+        table[0] = dict(self.goto[0])
+        queue = list(self.goto[0].values())
+        for state in queue:
+            transitions = dict(table[fail[state]])
+            transitions.update(self.goto[state])
+            table[state] = transitions
+            # Sequences ending in a suffix of this one also match here
+            self.outputs[state] = self.outputs[state] + self.outputs[fail[state]]
+            for code, next_state in self.goto[state].items():
+                fail[next_state] = table[fail[state]].get(code, 0)
+                queue.append(next_state)
+        self.table = table
+        self.outputs = [tuple(handlers) for handlers in self.outputs]
+
+    def key(self, t: int, code: int, state: bool):
+        if not state:
+            return
+        if t - self.last_time > self.timeout:
+            self.state = 0
+        self.last_time = t
+        self.state = self.table[self.state].get(code, 0)
+        handlers = self.outputs[self.state]
+        if len(handlers) != 0:
+            self.lm.call_handlers(handlers, ())
+
+################################################################################
+
+
+
+################################################################################
+# Statistics
+################################################################################
+
+# Histograms have one bucket per power of two (bucket n counts values
+# < 2**n and >= 2**(n-1)). Enough buckets for ~550 seconds in ns.
+STATS_BUCKETS = 40
+
+# Event types counted separately (anything else is counted as other)
+STATS_EVENT_TYPES = [
+    LibinputEventType.KEYBOARD_KEY,
+    LibinputEventType.POINTER_MOTION,
+    LibinputEventType.POINTER_BUTTON,
+    LibinputEventType.POINTER_SCROLL_WHEEL,
+]
+
+def histogram_percentile(hist, count: int, p: float) -> int:
+    # Upper bound of the bucket holding the p percentile
+    if count == 0:
+        return 0
+    target = count * p
+    seen = 0
+    for bucket, n in enumerate(hist):
+        seen += n
+        if seen >= target:
+            return 1 << bucket
+    return 1 << (len(hist) - 1)
+
+class Stats:
+    # Counters for the event loop. Everything is preallocated when LibMacro
+    # starts, so counting does not allocate (beyond Python ints).
+    #
+    # Read while running with SIGUSR1 (written to stderr) or by connecting to
+    # the stats socket (eg socat - UNIX-CONNECT:/path/to/socket).
+
+    def __init__(self, socket_path: Optional[str] = None):
+        self.socket_path = socket_path
+        self.socket = None
+        self.previous_handler = None
+        self.start_time = time.monotonic()
+
+        self.wakeups = 0
+        self.drains = 0
+        self.drain_events = 0
+        self.drain_sizes = array("Q", bytes(8 * STATS_BUCKETS))
+        self.type_index = {t: i for i, t in enumerate(STATS_EVENT_TYPES)}
+        self.type_other = len(STATS_EVENT_TYPES)
+        self.type_counts = array("Q", bytes(8 * (len(STATS_EVENT_TYPES) + 1)))
+        self.timers_run = 0
+
+        # Per handler (index from handler_index)
+        self.handler_names = []
+        self.handler_index = {}
+        self.handler_calls = array("Q")
+        self.handler_ns = array("Q")
+        self.handler_max_ns = array("Q")
+        self.handler_hist = array("Q")
+
+    def setup_handlers(self, handlers: List[Callable]):
+        for handler in handlers:
+            if handler in self.handler_index:
+                continue
+            self.handler_index[handler] = len(self.handler_names)
+            cls = type(getattr(handler, "__self__", None))
+            self.handler_names.append("{}.{}.{}".format(cls.__module__, cls.__name__, getattr(handler, "__name__", "?")))
+        n = len(self.handler_names)
+        self.handler_calls = array("Q", bytes(8 * n))
+        self.handler_ns = array("Q", bytes(8 * n))
+        self.handler_max_ns = array("Q", bytes(8 * n))
+        self.handler_hist = array("Q", bytes(8 * n * STATS_BUCKETS))
+
+    def count_drain(self, events: List[tuple]):
+        # Drain size and events by type
+        type_counts = self.type_counts
+        for event in events:
+            type_counts[self.type_index.get(event[1], self.type_other)] += 1
+        size = len(events)
+        self.drains += 1
+        self.drain_events += size
+        self.drain_sizes[min(size.bit_length(), STATS_BUCKETS - 1)] += 1
+
+    def count_handler(self, index: int, ns: int):
+        self.handler_calls[index] += 1
+        self.handler_ns[index] += ns
+        if ns > self.handler_max_ns[index]:
+            self.handler_max_ns[index] = ns
+        self.handler_hist[index * STATS_BUCKETS + min(ns.bit_length(), STATS_BUCKETS - 1)] += 1
+
+    def format(self, lm: "LibMacro") -> str:
+        uptime = max(1e-9, time.monotonic() - self.start_time)
+        lines = ["libmacro stats (uptime {:.1f} s)".format(uptime)]
+        lines.append("  poll wakeups: {} ({:.1f}/s)".format(self.wakeups, self.wakeups / uptime))
+        lines.append("  drains: {} (mean {:.2f} events, p99 <= {} events)".format(
+            self.drains, self.drain_events / max(1, self.drains),
+            histogram_percentile(self.drain_sizes, self.drains, 0.99)))
+        names = [t.name for t in STATS_EVENT_TYPES] + ["other"]
+        lines.append("  events: " + ", ".join("{} {}".format(name, n) for name, n in zip(names, self.type_counts)))
+        lines.append("  timers run: {}".format(self.timers_run))
+        lines.append("  input lost: {} events".format(lm.backend.dropped))
+        lines.append("  uinput: {} writes, {} events".format(lm.ui.sends, lm.ui.events_sent))
+        lines.append("  log: {} dropped, {} rate limited".format(log.dropped, log.suppressed))
+        if lm.low_latency is not None:
+            lines.append("  low latency: " + ", ".join(lm.low_latency.applied))
+        lines.append("  handlers:")
+        for i, name in enumerate(self.handler_names):
+            calls = self.handler_calls[i]
+            hist = self.handler_hist[i * STATS_BUCKETS:(i + 1) * STATS_BUCKETS]
+            lines.append("    {}: {} calls, mean {:.1f} us, p50 <= {:.1f} us, p99 <= {:.1f} us, max {:.1f} us".format(
+                name, calls, self.handler_ns[i] / max(1, calls) / 1000,
+                histogram_percentile(hist, calls, 0.50) / 1000,
+                histogram_percentile(hist, calls, 0.99) / 1000,
+                self.handler_max_ns[i] / 1000))
+        return "\n".join(lines) + "\n"
+
+    def open(self, lm: "LibMacro"):
+        def dump(signum, frame):
+            sys.stderr.write(self.format(lm))
+            sys.stderr.flush()
+        try:
+            self.previous_handler = signal.signal(signal.SIGUSR1, dump)
+        except ValueError:
+            # Not the main thread. Only the socket can be used.
+            pass
+
+        if self.socket_path is not None:
+            import socket
+            try:
+                mode = os.lstat(self.socket_path).st_mode
+            except FileNotFoundError:
+                mode = None
+            if mode is not None:
+                # Left over from an earlier run. Never delete anything else.
+                if not stat.S_ISSOCK(mode):
+                    raise Exception("Stats socket path {} exists and is not a socket".format(self.socket_path))
+                os.unlink(self.socket_path)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(self.socket_path)
+            self.socket.listen(4)
+            self.socket.setblocking(False)
+            lm.watch_fd(self.socket.fileno(), lambda: self.handle_connection(lm))
+
+    def handle_connection(self, lm: "LibMacro"):
+        # Write stats to each new connection and close it. Never blocks
+        # (stats that don't fit in the socket buffer are cut off).
+        while True:
+            try:
+                conn, _ = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                conn.setblocking(False)
+                conn.send(self.format(lm).encode())
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    def close(self, lm: "LibMacro"):
+        if self.previous_handler is not None:
+            try:
+                signal.signal(signal.SIGUSR1, self.previous_handler)
+            except ValueError:
+                pass
+            self.previous_handler = None
+        if self.socket is not None:
+            lm.unwatch_fd(self.socket.fileno())
+            self.socket.close()
+            self.socket = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+################################################################################
+
+
+
+################################################################################
+# Low latency mode
 ################################################################################
 
-udev = ctypes.CDLL("libudev.so")
+# From sys/mman.h
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+class LowLatency:
+    # Opt-in settings to reduce wakeup latency and jitter when sharing the
+    # CPU with something heavy (eg a game). Applied by LibMacro.start() and
+    # undone by LibMacro.stop(). Each setting falls back (or is skipped) if
+    # not permitted. What was applied is logged and kept in applied.
+    #
+    # policy:   "fifo" or "rr" real-time scheduling with priority. Without
+    #           permission (root or CAP_SYS_NICE / rtprio limit) falls back
+    #           to nice.
+    # cpus:     CPUs to run on (None = don't change affinity)
+    # mlock:    Lock all memory after warm-up so handlers never page fault.
+    #           Future allocations are only locked when there is no limit
+    #           on locked memory (so allocations can't start failing).
+    # prewarm:  Call scripts' prewarm() and freeze the garbage collector's
+    #           current objects (never scanned again) before locking.
+    #
+    # Scheduling and affinity are set before the backend is opened, so
+    # threads it starts (eg ThreadedBackend reader) inherit them. The log
+    # writer thread is started first so it doesn't.
+
+    def __init__(self, policy: str = "fifo", priority: int = 10, nice: int = -10,
+                 cpus: Optional[List[int]] = None, mlock: bool = True, prewarm: bool = True):
+        self.policy = policy
+        self.priority = priority
+        self.nice = nice
+        self.cpus = cpus
+        self.mlock = mlock
+        self.prewarm = prewarm
+        self.applied = []
 
-udev.udev_new.argtypes = None
-udev.udev_new.restype = ctypes.c_void_p
+        # Original settings (restored by restore)
+        self.old_scheduler = None
+        self.old_nice = None
+        self.old_cpus = None
+        self.locked = False
+        self.frozen = False
 
-udev.udev_unref.argtypes = [ctypes.c_void_p]
-udev.udev_unref.restype = ctypes.c_void_p
+    def apply_scheduling(self):
+        log.start()
+        self.applied = []
+
+        policy = os.SCHED_FIFO if self.policy == "fifo" else os.SCHED_RR
+        try:
+            self.old_scheduler = (os.sched_getscheduler(0), os.sched_getparam(0))
+            os.sched_setscheduler(0, policy, os.sched_param(self.priority))
+            self.applied.append("SCHED_{} priority {}".format(self.policy.upper(), self.priority))
+        except OSError as e:
+            self.old_scheduler = None
+            try:
+                self.old_nice = os.getpriority(os.PRIO_PROCESS, 0)
+                os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+                self.applied.append("nice {} (real-time scheduling not permitted: {})".format(self.nice, e.strerror))
+            except OSError as e2:
+                self.old_nice = None
+                self.applied.append("default scheduling (real-time: {}, nice: {})".format(e.strerror, e2.strerror))
+
+        if self.cpus is not None:
+            try:
+                self.old_cpus = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, self.cpus)
+                self.applied.append("CPUs {}".format(",".join(str(cpu) for cpu in sorted(self.cpus))))
+            except OSError as e:
+                self.old_cpus = None
+                self.applied.append("any CPU (affinity failed: {})".format(e.strerror))
+
+    def apply_memory(self, lm: "LibMacro"):
+        # After everything is opened, so it is all warm and locked
+        if self.prewarm:
+            import gc
+            for script in lm.scripts:
+                script.prewarm()
+            # Scripts must not generate output from prewarm
+            lm.ui.discard()
+            gc.collect()
+            gc.freeze()
+            self.frozen = True
+            self.applied.append("prewarmed, {} objects frozen".format(gc.get_freeze_count()))
+
+        if self.mlock:
+            import resource
+            flags = MCL_CURRENT
+            if resource.getrlimit(resource.RLIMIT_MEMLOCK)[0] == resource.RLIM_INFINITY:
+                flags |= MCL_FUTURE
+            try:
+                result = libc.mlockall(flags)
+                error = os.strerror(ctypes.get_errno()) if result != 0 else None
+            except Exception as e:
+                result, error = -1, str(e)
+            if result == 0:
+                self.locked = True
+                self.applied.append("memory locked" + (" (current and future)" if flags & MCL_FUTURE else " (current)"))
+            else:
+                self.applied.append("memory not locked ({})".format(error))
+
+        log.info("Low latency mode: {}", ", ".join(self.applied))
+
+    def restore(self):
+        if self.locked:
+            libc.munlockall()
+            self.locked = False
+        if self.frozen:
+            # So the next run's objects (or anything after it) are collected normally
+            import gc
+            gc.unfreeze()
+            self.frozen = False
+        try:
+            if self.old_scheduler is not None:
+                os.sched_setscheduler(0, self.old_scheduler[0], self.old_scheduler[1])
+            if self.old_nice is not None:
+                os.setpriority(os.PRIO_PROCESS, 0, self.old_nice)
+            if self.old_cpus is not None:
+                os.sched_setaffinity(0, self.old_cpus)
+        except OSError:
+            # Lowering priority is always allowed, raising nice back may not be
+            pass
+        self.old_scheduler = self.old_nice = self.old_cpus = None
 
 ################################################################################
 
@@ -138,21 +2871,36 @@ udev.udev_unref.restype = ctypes.c_void_p
 
 class LibMacroScript(ABC):
 
+    # Keys and buttons are only tracked (is_pressed) if some script handles
+    # key / button events. Set True to track them regardless.
+    track_input_state = False
+
+    # Scroll wheel events are only read if some script handles them. Set
+    # True to read them regardless (eg to record them). Like bursts, this only
+    # observes (grabbed devices still pass the scrolling through).
+    track_scroll = False
+
     def __init__(self):
         self.lm = None
 
-    @abstractmethod
+    # Override to receive every event of the type. Prefer the on_* decorators
+    # when only some keys / buttons are needed.
     def handle_key(self, keycode: int, pressed: bool):
         pass
 
-    @abstractmethod
     def handle_mouse_button(self, button: int, pressed: bool):
         pass
 
-    @abstractmethod
     def handle_mouse_scroll(self, vertical: bool, distance: float):
         pass
 
+    # Called after input events were lost (dropped is how many, or 1 if
+    # unknown). Held keys have already been resynced: press / release events
+    # were generated for keys whose state differs from the devices (or
+    # releases for every held key if the backend can't read device state).
+    def handle_resync(self, dropped: int):
+        pass
+
     def key_events_generated(self) -> List[int]:
         return []
     
@@ -160,119 +2908,736 @@ class LibMacroScript(ABC):
         return []
 
     def press_key(self, key):
-        self.lm.ui.write(ecodes.EV_KEY, key, 1)
+        self.lm.ui.write(EV_KEY, key, 1)
         self.lm.ui.syn()
 
     def release_key(self, key):
-        self.lm.ui.write(ecodes.EV_KEY, key, 0)
+        self.lm.ui.write(EV_KEY, key, 0)
         self.lm.ui.syn()
     
-    def type_key(self, key, delay=0):
-        self.lm.ui.write(ecodes.EV_KEY, key, 1)
-        time.sleep(delay)
-        self.lm.ui.write(ecodes.EV_KEY, key, 0)
+    def type_key(self, key, delay=0) -> Optional[TimerHandle]:
+        # Press and release a key. With a delay the release is scheduled (the
+        # handler returns immediately) and its TimerHandle is returned.
+        self.lm.ui.write(EV_KEY, key, 1)
         self.lm.ui.syn()
+        if delay > 0:
+            return self.release_key_after(delay, key)
+        self.lm.ui.write(EV_KEY, key, 0)
+        self.lm.ui.syn()
+        return None
     
     def scroll_wheel_vertical(self, distance: int):
         # Multiply by negative 1 b/c libinput and evdev use opposite signs for directions
-        self.lm.ui.write(ecodes.EV_REL, ecodes.REL_WHEEL, -1 * distance)
+        self.lm.ui.write(EV_REL, REL_WHEEL, -1 * distance)
         self.lm.ui.syn()
 
     def scroll_wheel_horizontal(self, distance: int):
         # Multiply by negative 1 b/c libinput and evdev use opposite signs for directions
         # TODO: This may not be so for horizontal. Need to test.
-        self.lm.ui.write(ecodes.EV_REL, ecodes.REL_HWHEEL, -1 * distance)
+        self.lm.ui.write(EV_REL, REL_HWHEEL, -1 * distance)
         self.lm.ui.syn()
 
+    def is_pressed(self, key: int) -> bool:
+        # Is an input key / button currently held
+        return self.lm.pressed[key] != 0
+
+    # Called before handling input in low latency mode (LowLatency prewarm)
+    # to run handler code paths once (imports, caches, etc), so that isn't
+    # done while handling the first events. Must not generate output.
+    def prewarm(self):
+        pass
+
+    def output_frame(self):
+        # Context manager. Everything generated inside is sent as one input
+        # frame (one SYN_REPORT), e.g. to press several keys at once.
+        return self.lm.ui.frame()
+
+    # Timers run from the event loop, so handlers should use these instead of
+    # time.sleep (which stalls handling of all other input events)
+    def schedule(self, delay: float, fn: Callable, *args: Any) -> TimerHandle:
+        return self.lm.schedule(delay, fn, *args)
+
+    def press_key_after(self, delay: float, key) -> TimerHandle:
+        return self.lm.schedule(delay, self.press_key, key)
+
+    def release_key_after(self, delay: float, key) -> TimerHandle:
+        return self.lm.schedule(delay, self.release_key, key)
+
+    def record_macro(self, exclude: List[int] = ()) -> MacroRecorder:
+        # Start recording input. Call stop() on the recorder to get the Macro.
+        recorder = MacroRecorder(self.lm, exclude)
+        recorder.start()
+        return recorder
+
+    def play_macro(self, macro: Macro, speed: float = 1.0, on_done: Optional[Callable] = None) -> MacroPlayer:
+        # Start playing a macro. Every key / wheel it uses must be in
+        # key_events_generated / rel_events_generated.
+        player = MacroPlayer(self.lm, macro, speed, on_done)
+        player.start()
+        return player
+
 class LibMacro:
 
-    def __init__(self, script: LibMacroScript):
-        # Make sure given script file exists and has required attributes
-        self.script = script
-        self.script.lm = self
+    def __init__(self, scripts, backend: Optional[InputBackend] = None, sink: Optional[OutputSink] = None, stats: Optional[Stats] = None,
+                 low_latency: Optional[LowLatency] = None):
+        # scripts: One LibMacroScript or a list of them. Multiple scripts share
+        # the backend and uinput device. Each event is passed to the scripts'
+        # handlers in list order.
+        # stats: Collect statistics (see Stats). None = no instrumentation.
+        if isinstance(scripts, LibMacroScript):
+            scripts = [scripts]
+        self.scripts = list(scripts)
+        self.script = self.scripts[0]
+        for script in self.scripts:
+            script.lm = self
+
+        # Default is real input devices and a real uinput device
+        self.backend = backend if backend is not None else LibinputBackend()
+        self.ui = sink if sink is not None else UInputSink()
+        self.clock = self.backend.clock
+        self.dispatch_tables = {}
+        self.scroll_stages = []
+        self.motion_stage = None
+        self.consumed_keys = bytearray(KEY_CNT)
+        self.consumed_scroll = bytearray(2 * len(ScrollAxis))
+        self.consumed_motion = False
+        self.stats = stats
+        self.low_latency = low_latency
+
+        # Lost input events already reported to the scripts
+        self.dropped = 0
+
+        # Held keys and buttons (1 byte per code) and chord / sequence
+        # matchers passed every key and button event
+        self.pressed = bytearray(KEY_CNT)
+        self.key_matchers = []
+
+        # Running MacroRecorders (passed every event)
+        self.recorders = []
+
+        # Other file descriptors to watch (fd: callback when readable)
+        self.watches = {}
+
+        # Pending timers. Heap of (deadline, sequence number, handle).
+        # Sequence number keeps timers with the same deadline in FIFO order.
+        self.timers = []
+        self.timer_seq = itertools.count()
+
+        # Wakes the event loop for timers (None = poll timeout is used, eg
+        # with a virtual clock)
+        self.timer_fd = None
+
+        # Only used by run_async
+        self.async_loop = None
+        self.async_done = None
+        self.async_timer = None
+        self.async_readers = set()
+        self.tasks = set()
+
+    def schedule(self, delay: float, fn: Callable, *args: Any) -> TimerHandle:
+        # Run fn(*args) from the event loop after delay seconds
+        return self.schedule_at(self.clock() + delay, fn, *args)
+
+    def schedule_at(self, deadline: float, fn: Callable, *args: Any) -> TimerHandle:
+        # Run fn(*args) from the event loop once clock() reaches deadline.
+        # Timers chained on absolute deadlines don't drift.
+        handle = TimerHandle(deadline, fn, args)
+        heapq.heappush(self.timers, (handle.deadline, next(self.timer_seq), handle))
+        if self.async_loop is not None and handle is self.timers[0][2]:
+            # New earliest deadline
+            self.arm_async_timer()
+        return handle
+
+    def next_deadline(self) -> Optional[float]:
+        # Deadline of the next pending timer (None = no timers)
+        while len(self.timers) != 0 and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if len(self.timers) == 0:
+            return None
+        return self.timers[0][0]
+
+    def poll_timeout(self) -> int:
+        # Milliseconds until the next timer is due or the backend needs to be
+        # read (-1 = block until input is available)
+        # With a timerfd it is armed for the next timer instead. Otherwise the
+        # timeout is rounded up so poll doesn't wake just before the deadline
+        # and spin.
+        timeout = self.backend.poll_timeout()
+        deadline = self.next_deadline()
+        if self.timer_fd is not None:
+            self.timer_fd.arm(deadline)
+        elif deadline is not None:
+            timer_timeout = max(0, math.ceil((deadline - self.clock()) * 1000))
+            if timeout < 0 or timer_timeout < timeout:
+                timeout = timer_timeout
+        return timeout
+
+    def run_timers(self):
+        # Run all timers that were due when this pass started. Timers
+        # scheduled by a timer callback (even with zero delay) are due after
+        # that with the real clock, so they run on the next wakeup (right
+        # away, since the timerfd / poll timeout is already expired). This
+        # keeps a timer that keeps rescheduling itself from starving input.
+        now = self.clock()
+        while len(self.timers) != 0 and self.timers[0][0] <= now:
+            handle = heapq.heappop(self.timers)[2]
+            if handle.cancelled:
+                continue
+            handle.done = True
+            if self.stats is not None:
+                self.stats.timers_run += 1
+            result = handle.fn(*handle.args)
+            if result is not None:
+                self.spawn(result)
+
+    def compile_subscriptions(self):
+        # Build dispatch tables from the scripts' on_* subscriptions and
+        # overridden handle_* methods
+        tables = {
+            LibinputEventType.KEYBOARD_KEY: DispatchTable(KEY_CNT),
+            LibinputEventType.POINTER_BUTTON: DispatchTable(KEY_CNT),
+            LibinputEventType.POINTER_SCROLL_WHEEL: DispatchTable(len(ScrollAxis)),
+            # Motion goes to the motion stage (no per event handlers)
+            LibinputEventType.POINTER_MOTION: DispatchTable(0),
+        }
+        used = set()
+        stages = {}
+        motion = None
+        chords = ChordMatcher(self)
+        sequences = {}
+
+        for script in self.scripts:
+            cls = type(script)
+            for name in dir(cls):
+                fn = getattr(cls, name, None)
+                for evtype, codes, states in getattr(fn, "libmacro_subscriptions", []):
+                    tables[evtype].add(codes, states, getattr(script, name))
+                    used.add(evtype)
+                window = getattr(fn, "libmacro_scroll_burst", None)
+                if window is not None:
+                    # One stage per window length
+                    if window not in stages:
+                        stages[window] = ScrollStage(self, window)
+                    stages[window].handlers.append(getattr(script, name))
+                    used.add(LibinputEventType.POINTER_SCROLL_WHEEL)
+                output = getattr(fn, "libmacro_motion", None)
+                if output is not None:
+                    if motion is None:
+                        motion = MotionStage(self)
+                    motion.handlers.append(getattr(script, name))
+                    motion.output = motion.output or output
+                    used.add(LibinputEventType.POINTER_MOTION)
+                for elements, pressed in getattr(fn, "libmacro_chords", []):
+                    chords.add(elements, pressed, getattr(script, name))
+                for keys, timeout in getattr(fn, "libmacro_sequences", []):
+                    # One automaton per timeout
+                    if timeout not in sequences:
+                        sequences[timeout] = SequenceMatcher(self, timeout)
+                    sequences[timeout].add(keys, getattr(script, name))
+
+            if script.track_input_state:
+                used.add(LibinputEventType.KEYBOARD_KEY)
+                used.add(LibinputEventType.POINTER_BUTTON)
+            if script.track_scroll:
+                used.add(LibinputEventType.POINTER_SCROLL_WHEEL)
+
+            catch_all = [
+                ("handle_key", LibinputEventType.KEYBOARD_KEY, range(KEY_CNT)),
+                ("handle_mouse_button", LibinputEventType.POINTER_BUTTON, range(KEY_CNT)),
+                ("handle_mouse_scroll", LibinputEventType.POINTER_SCROLL_WHEEL, list(ScrollAxis)),
+            ]
+            for name, evtype, codes in catch_all:
+                if getattr(cls, name) is not getattr(LibMacroScript, name):
+                    tables[evtype].add(codes, [0, 1], getattr(script, name))
+                    used.add(evtype)
+
+        self.key_matchers = []
+        if len(chords.sizes) != 0:
+            self.key_matchers.append(chords)
+        for matcher in sequences.values():
+            matcher.compile()
+            self.key_matchers.append(matcher)
+        for matcher in self.key_matchers:
+            for code in matcher.codes():
+                used.add(key_event_type(code))
+
+        # What grabbed devices don't pass through: presses of keys / buttons
+        # with handlers or used by matchers, scroll directions with handlers
+        # and motion replaced by the motion stage. Bursts, track_input_state,
+        # track_scroll and motion handlers without output only observe.
+        self.consumed_keys = bytearray(KEY_CNT)
+        for code in range(KEY_CNT):
+            self.consumed_keys[code] = tables[key_event_type(code)].entries[(code << 1) | 1] is not None
+        for matcher in self.key_matchers:
+            for code in matcher.codes():
+                self.consumed_keys[code] = 1
+        scroll = tables[LibinputEventType.POINTER_SCROLL_WHEEL].entries
+        self.consumed_scroll = bytearray(entry is not None for entry in scroll)
+        self.consumed_motion = motion is not None and motion.output
+
+        # Event types nobody handles have no table (dropped in dispatch)
+        self.dispatch_tables = {evtype: tables[evtype].entries for evtype in used}
+        self.scroll_stages = list(stages.values())
+        self.motion_stage = motion
+
+        if self.stats is not None:
+            handlers = []
+            for entries in self.dispatch_tables.values():
+                for entry in entries:
+                    if entry is not None:
+                        handlers.extend(entry)
+            for stage in self.scroll_stages:
+                handlers.extend(stage.handlers)
+            if self.motion_stage is not None:
+                handlers.extend(self.motion_stage.handlers)
+            for matcher in self.key_matchers:
+                handlers.extend(matcher.handlers())
+            self.stats.setup_handlers(handlers)
+
+            # Timed version replaces call_handlers for this instance
+            self.call_handlers = self.call_handlers_with_stats
+
+    def subscribed_types(self) -> set:
+        # Event types the scripts handle. Backends may skip decoding others.
+        return set(self.dispatch_tables)
+
+    def dispatch(self, event: tuple):
+        # Pass one input event (see Input backends) to subscribed handlers
+        t, evtype, code, value = event
+        table = self.dispatch_tables.get(evtype)
+        if table is None:
+            if evtype & PASSTHROUGH_MASK == PASSTHROUGH:
+                self.pass_through(evtype & ~PASSTHROUGH_MASK, code, value)
+            return
+        if evtype == LibinputEventType.POINTER_SCROLL_WHEEL:
+            for stage in self.scroll_stages:
+                stage.add(event)
+            # SCROLL_V120 codes are past the end of the table
+            index = (code << 1) | (value > 0)
+            args = (code == ScrollAxis.VERTICAL, value)
+        elif evtype == LibinputEventType.POINTER_MOTION:
+            self.motion_stage.add(t, code, value)
+            return
+        else:
+            # Keys and buttons. State is updated before any handler runs.
+            state = value != 0
+            self.pressed[code] = state
+            for matcher in self.key_matchers:
+                matcher.key(t, code, state)
+            index = (code << 1) | state
+            args = (code, state)
+        if index >= len(table):
+            return
+        handlers = table[index]
+        if handlers is None:
+            return
+        self.call_handlers(handlers, args)
+
+    def pass_through(self, etype: int, code: int, value):
+        # Send an event of a grabbed device nothing handles on unchanged
+        if etype == EV_SYN:
+            self.ui.syn()
+        else:
+            self.ui.write(etype, code, int(value))
+
+    def is_pressed(self, key: int) -> bool:
+        # Is an input key / button currently held (see track_input_state)
+        return self.pressed[key] != 0
+
+    def resync(self):
+        # Input was lost. Make held keys match the devices (or release all of
+        # them if the backend can't tell) by generating events for differences.
+        dropped = self.backend.dropped - self.dropped
+        self.dropped = self.backend.dropped
+        log.warning("Input overflow: {} events lost, key state resynced", dropped)
+        state = self.backend.key_state()
+
+        # Release keys of grabbed devices that were passed through (the
+        # uinput device would hold them until exit)
+        for code in self.backend.lost_passthrough(state):
+            if code in self.ui.held:
+                self.ui.write(EV_KEY, code, 0)
+        self.ui.syn()
+
+        t = int(self.clock() * 1000000)
+        for code in range(KEY_CNT):
+            held = state is not None and has_bit(state, code)
+            if (self.pressed[code] != 0) != held:
+                self.dispatch((t, key_event_type(code), code, 1 if held else 0))
+        for script in self.scripts:
+            result = script.handle_resync(dropped)
+            if result is not None:
+                self.spawn(result)
+
+    def call_handlers(self, handlers: List[Callable], args: tuple):
+        # Call handlers with the same arguments (from dispatch, stages and
+        # matchers)
+        for handler in handlers:
+            result = handler(*args)
+            if result is not None:
+                self.spawn(result)
+
+    def call_handlers_with_stats(self, handlers: List[Callable], args: tuple):
+        # Same as call_handlers, but times each handler
+        stats = self.stats
+        for handler in handlers:
+            start = time.perf_counter_ns()
+            result = handler(*args)
+            stats.count_handler(stats.handler_index[handler], time.perf_counter_ns() - start)
+            if result is not None:
+                self.spawn(result)
+
+    def watch_fd(self, fd: int, callback: Callable):
+        # Call callback() from the event loop when fd is readable
+        self.watches[fd] = callback
+        self.backend.fds_changed = True
+
+    def unwatch_fd(self, fd: int):
+        self.watches.pop(fd, None)
+        self.backend.fds_changed = True
+
+    def poll_fds(self) -> set:
+        return set(self.backend.filenos()) | set(self.watches)
+
+    def spawn(self, result: Any):
+        # Handlers and timer callbacks may be coroutines (async def) when
+        # running with run_async. They run as tasks on the event loop.
+        import asyncio
+        if not asyncio.iscoroutine(result):
+            return
+        if self.async_loop is None:
+            result.close()
+            raise Exception("Coroutine handlers require LibMacro.run_async.")
+        task = self.async_loop.create_task(result)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if self.async_done is None or self.async_done.done():
+            return
+        if not task.cancelled() and task.exception() is not None:
+            # Same as an exception in a regular handler (stops the loop)
+            self.async_done.set_exception(task.exception())
+        elif not self.running():
+            self.async_done.set_result(None)
+
+    def start(self):
+        # Start the log writer now instead of from the first record (which
+        # may be logged by a handler). Before low latency scheduling, so the
+        # writer thread doesn't inherit it.
+        log.start()
+        self.compile_subscriptions()
+        if self.low_latency is not None:
+            self.low_latency.apply_scheduling()
+        self.backend.open(self)
+
+        if self.backend.monotonic_clock():
+            try:
+                self.timer_fd = TimerFd()
+                self.watch_fd(self.timer_fd.fd, self.timer_fd.expired)
+            except Exception as e:
+                self.timer_fd = None
+                log.warning("timerfd not available, timers use the poll timeout (ms resolution): {}", e)
 
-    def run(self):
-        # Initialize udev and libinput to monitor input events
-        self.m_udev = udev.udev_new()
-        self.m_libinput_iface  = libinput_interface(CFUNC_OPEN_RESTRICTED(libinput_open_restricted), CFUNC_CLOSE_RESTRICTED(libinput_close_restricted))
-        self.m_libinput = libinput.libinput_udev_create_context(ctypes.byref(self.m_libinput_iface), None, self.m_udev)
-        rc = libinput.libinput_udev_assign_seat(self.m_libinput, "seat0".encode())
-        if rc != 0:
-            raise Exception("Failed to initialize libinput and udev. Try running as root.")
-        
         # Create uinput object to generate input
+        # One device with everything any script generates (and grabbed
+        # devices pass through)
         events = {}
-        if len(self.script.key_events_generated()) != 0:
-            events[ecodes.EV_KEY] = self.script.key_events_generated()
-        if len(self.script.rel_events_generated()) != 0:
-            events[ecodes.EV_REL] = self.script.rel_events_generated()
-        self.ui = uinput.UInput(events, name="libmacro-uinput")
+        key_lists = [script.key_events_generated() for script in self.scripts]
+        rel_lists = [script.rel_events_generated() for script in self.scripts]
+        if self.motion_stage is not None and self.motion_stage.output:
+            rel_lists.append([REL_X, REL_Y])
+        passthrough = self.backend.passthrough_capabilities()
+        key_lists.append(passthrough.get(EV_KEY, []))
+        rel_lists.append(passthrough.get(EV_REL, []))
+        keys = self.merged_codes(key_lists)
+        if len(keys) != 0:
+            events[EV_KEY] = keys
+        rels = self.merged_codes(rel_lists)
+        if len(rels) != 0:
+            events[EV_REL] = rels
+        self.ui.capabilities = events
+        self.ui.open(self, events)
+
+        if self.stats is not None:
+            self.stats.open(self)
+
+        if self.low_latency is not None:
+            self.low_latency.apply_memory(self)
+
+    @staticmethod
+    def merged_codes(code_lists) -> List[int]:
+        # Union of code lists (first occurrence order)
+        merged = {}
+        for codes in code_lists:
+            for code in codes:
+                merged[code] = None
+        return list(merged)
+
+    def running(self) -> bool:
+        # Stops once the backend is finished (replay) and no timers or
+        # coroutine handlers are left
+        return not self.backend.finished() or self.next_deadline() is not None or len(self.tasks) != 0
+
+    def process(self, ready: List[int]):
+        # One pass through the event loop
+        # Handles all available events, then runs due timers, then sends
+        # everything generated
+        events = self.backend.read_events(self.next_deadline(), ready)
+        if self.stats is not None:
+            self.stats.wakeups += 1
+            self.stats.count_drain(events)
+        recorders = self.recorders
+        for event in events:
+            self.dispatch(event)
+            # After dispatch, so the event starting / stopping a recording
+            # is not part of it
+            if len(recorders) != 0:
+                for recorder in list(recorders):
+                    recorder.record(event)
+
+        # Input was lost (overflow)
+        if self.backend.dropped != self.dropped:
+            self.resync()
+
+        # Scroll bursts without a window and motion batches end with the drain
+        for stage in self.scroll_stages:
+            if stage.window == 0.0:
+                stage.flush()
+        if self.motion_stage is not None:
+            self.motion_stage.flush()
+
+        # Other watched file descriptors
+        if len(self.watches) != 0:
+            for fd in ready:
+                callback = self.watches.get(fd)
+                if callback is not None:
+                    callback()
+
+        # Timers may have come due while handling events
+        self.run_timers()
+
+        # Send everything generated in this pass
+        self.ui.commit()
+
+    def stop(self):
+        # Don't leave keys stuck down, then cleanup
+        try:
+            self.ui.release_held()
+            self.ui.commit()
+        except Exception:
+            log.exception("Failed to release held keys")
+        if self.stats is not None:
+            self.stats.close(self)
+        if self.timer_fd is not None:
+            self.unwatch_fd(self.timer_fd.fd)
+            self.timer_fd.close()
+            self.timer_fd = None
+        self.ui.close()
+        self.backend.close()
+        if self.low_latency is not None:
+            self.low_latency.restore()
+        log.flush()
+
+    def run(self):
+        self.start()
 
         # Event loop
-        # Polls file descriptor until events available (POLLIN)
+        # Polls backend file descriptors until events available (POLLIN) or next timer is due
         # Then handles all events
+        # Then runs due timers
         # Then polls again
         poll = select.poll()
-        poll.register(libinput.libinput_get_fd(self.m_libinput), select.POLLIN)    
+        registered = self.poll_fds()
+        for fd in registered:
+            poll.register(fd, select.POLLIN)
         try:
-            while True:
-                revents = poll.poll()
-                if len(revents) == 0:
-                    # Nothing returned from polling. Just repeat poll.
-                    continue
+            while self.running():
+                ready = [fd for fd, _ in poll.poll(self.poll_timeout())]
+                self.process(ready)
 
-                # Got pollin (only thing polling for), handle all events
-                while True:
-                    libinput.libinput_dispatch(self.m_libinput)
-                    ev = libinput.libinput_get_event(self.m_libinput)
-                    if ev is None:
-                        break # Back to polling (no more events to handle)
-
-                    # Don't handle events generated by libmacro's input device
-                    dev = libinput.libinput_event_get_device(ev)
-                    name = libinput.libinput_device_get_name(dev).decode()
-                    if name == "libmacro-uinput":
-                        continue
-
-                    evtype = libinput.libinput_event_get_type(ev)
-                    if evtype == 402:                   # LIBINPUT_EVENT_POINTER_BUTTON
-                        # Mouse buttons
-                        pev = libinput.libinput_event_get_pointer_event(ev)
-                        button = libinput.libinput_event_pointer_get_button(pev)
-                        if libinput.libinput_event_pointer_get_button_state(pev):
-                            self.script.handle_mouse_button(button, True)
-                        else:
-                            self.script.handle_mouse_button(button, False)
-
-                    elif evtype == 404:                 # LIBINPUT_EVENT_POINTER_SCROLL_WHEEL
-                        # Scroll wheel (0 = vertical, 1 = horizontal)
-                        pev = libinput.libinput_event_get_pointer_event(ev)
-                        if libinput.libinput_event_pointer_has_axis(pev, 0):
-                            value = libinput.libinput_event_pointer_get_scroll_value(pev, 0)
-                            self.script.handle_mouse_scroll(True, value)
-                        elif libinput.libinput_event_pointer_has_axis(pev, 1):
-                            value = libinput.libinput_event_pointer_get_scroll_value(pev, 1)
-                            self.script.handle_mouse_scroll(False, value)
-
-                    elif evtype == 300:                 # LIBINPUT_EVENT_KEYBOARD_KEY
-                        # Keyboard keys
-                        kev = libinput.libinput_event_get_keyboard_event(ev)
-                        button = libinput.libinput_event_keyboard_get_key(kev)
-                        if libinput.libinput_event_keyboard_get_key_state(kev):
-                            self.script.handle_key(button, True)
-                        else:
-                            self.script.handle_key(button, False)
-                    libinput.libinput_event_destroy(ev)
+                # Devices may have been added or removed
+                if self.backend.fds_changed:
+                    self.backend.fds_changed = False
+                    fds = self.poll_fds()
+                    for fd in registered - fds:
+                        poll.unregister(fd)
+                    for fd in fds - registered:
+                        poll.register(fd, select.POLLIN)
+                    registered = fds
 
         except KeyboardInterrupt:
             # Silent exit
             pass
         except:
-            traceback.print_exc()
+            log.exception("Event loop stopped by exception")
 
-        # Cleanup
-        self.ui.close()
-        libinput.libinput_unref(self.m_libinput)
-        udev.udev_unref(self.m_udev)
+        self.stop()
+
+    async def run_async(self):
+        # Same as run, but on the running asyncio event loop so scripts can
+        # use other asyncio code (sockets, tasks, etc) alongside input handling.
+        # Handlers may be coroutines. Cancelling this releases held keys and
+        # closes the backend.
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.start()
+        self.async_loop = loop
+        self.async_done = loop.create_future()
+        self.async_readers = set()
+        self.ui.loop = loop
+        self.update_async_readers()
+        self.arm_async_timer()
+        try:
+            await self.async_done
+        except Exception:
+            log.exception("Event loop stopped by exception")
+        finally:
+            for fd in self.async_readers:
+                loop.remove_reader(fd)
+            self.async_readers = set()
+            if self.async_timer is not None:
+                self.async_timer.cancel()
+                self.async_timer = None
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            if len(tasks) != 0:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.async_loop = None
+            self.ui.loop = None
+            self.stop()
+
+    def update_async_readers(self):
+        fds = self.poll_fds()
+        for fd in self.async_readers - fds:
+            self.async_loop.remove_reader(fd)
+        for fd in fds - self.async_readers:
+            self.async_loop.add_reader(fd, self.async_process, [fd])
+        self.async_readers = fds
+
+    def async_process(self, ready: List[int]):
+        # Called by the asyncio loop when a backend fd is readable or a
+        # timer / backend timeout is due
+        if self.async_done.done():
+            return
+        try:
+            self.process(ready)
+
+            # Devices may have been added or removed
+            if self.backend.fds_changed:
+                self.backend.fds_changed = False
+                self.update_async_readers()
+
+            if self.running():
+                self.arm_async_timer()
+            else:
+                self.async_done.set_result(None)
+        except BaseException as e:
+            self.async_done.set_exception(e)
+
+    def arm_async_timer(self):
+        # Wake for the next timer / backend timeout (replaces earlier wakeup)
+        if self.async_timer is not None:
+            self.async_timer.cancel()
+            self.async_timer = None
+        timeout = self.poll_timeout()
+        if timeout >= 0:
+            self.async_timer = self.async_loop.call_later(timeout / 1000, self.async_process, [])
+
+################################################################################
 
-################################################################################
\ No newline at end of file
+
+
+################################################################################
+# Command line
+################################################################################
+
+def load_script(spec: str) -> LibMacroScript:
+    # Create a script from a module name (ToggleSprintBedrock), a file path
+    # (./ToggleSprintBedrock.py) or either followed by :ClassName (default
+    # class name is Script)
+    import importlib
+    import importlib.util
+    path, _, class_name = spec.partition(":")
+    if class_name == "":
+        class_name = "Script"
+    if path.endswith(".py") or os.sep in path:
+        # Make sure given script file exists and has required attributes
+        if not os.path.isfile(path):
+            raise Exception("Script file {} does not exist".format(path))
+        name = os.path.splitext(os.path.basename(path))[0]
+        module_spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(path)
+    cls = getattr(module, class_name, None)
+    if cls is None or not isinstance(cls, type) or not issubclass(cls, LibMacroScript):
+        raise Exception("{} has no LibMacroScript class named {}".format(path, class_name))
+    return cls()
+
+def run_script(scripts, argv: Optional[List[str]] = None):
+    # Standard entry point for scripts. Runs the script (or list of scripts)
+    # on real devices or records / replays a trace file.
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record", metavar="TRACE", help="Record input events to a trace file while running")
+    parser.add_argument("--replay", metavar="TRACE", help="Replay input events from a trace file instead of using real devices. Generated events are printed instead of sent to a uinput device.")
+    parser.add_argument("--max-speed", action="store_true", help="With --replay, replay as fast as possible (using recorded times for timers) instead of at recorded speed")
+    parser.add_argument("--all-devices", action="store_true", help="Open every input device on the seat instead of only devices that can generate events the script handles")
+    parser.add_argument("--backend", choices=["libinput", "evdev"], default="libinput", help="Read devices using libinput (default) or directly (evdev)")
+    parser.add_argument("--grab", action="store_true", help="With --backend evdev, grab devices so no other program receives their events. "
+                             "Key presses, buttons and scroll directions the scripts handle (or use in chords / sequences) "
+                             "are consumed; everything else is passed through")
+    parser.add_argument("--reader-thread", action="store_true", help="Read input on a separate thread so slow handlers can't make input buffers overflow")
+    parser.add_argument("--queue-size", type=int, default=READER_QUEUE_SIZE, help="With --reader-thread, number of events that can be queued (power of 2, default {})".format(READER_QUEUE_SIZE))
+    parser.add_argument("--low-latency", action="store_true", help="Use real-time scheduling (or nice), lock memory and prewarm handlers (see LowLatency). Works best as root.")
+    parser.add_argument("--cpu", type=int, nargs="+", metavar="N", help="With --low-latency, only run on these CPUs")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Run on an asyncio event loop (required for scripts with async handlers)")
+    parser.add_argument("--no-stats", action="store_true", help="Disable statistics (otherwise written to stderr on SIGUSR1)")
+    parser.add_argument("--stats-socket", metavar="PATH", help="Also serve statistics on this unix socket")
+    parser.add_argument("--log-level", choices=[level.name.lower() for level in LogLevel], default="info", help="Lowest level of log messages to write (default info)")
+    args = parser.parse_args(argv)
+    log.level = LogLevel[args.log_level.upper()]
+    if args.grab and (args.backend != "evdev" or args.replay is not None):
+        parser.error("--grab requires --backend evdev (and can't be used with --replay)")
+
+    if args.replay is not None:
+        backend = TraceReplayBackend(args.replay, realtime=not args.max_speed)
+        sink = MemorySink()
+    else:
+        if args.backend == "evdev":
+            backend = EvdevBackend(grab=args.grab)
+        else:
+            backend = LibinputBackend(filter_devices=not args.all_devices)
+        sink = UInputSink()
+    if args.record is not None:
+        backend = TraceRecorder(backend, args.record)
+    if args.reader_thread:
+        if args.replay is not None and args.max_speed:
+            parser.error("--reader-thread can't be used with --max-speed")
+        if args.queue_size <= 0 or args.queue_size & (args.queue_size - 1) != 0:
+            parser.error("--queue-size must be a power of 2")
+        backend = ThreadedBackend(backend, args.queue_size)
+
+    print("STARTING. Press Ctrl+C to exit.", flush=True)
+    stats = None if args.no_stats else Stats(args.stats_socket)
+    low_latency = LowLatency(cpus=args.cpu) if args.low_latency else None
+    lm = LibMacro(scripts, backend, sink, stats, low_latency)
+    if args.use_async:
+        import asyncio
+        try:
+            asyncio.run(lm.run_async())
+        except KeyboardInterrupt:
+            # Silent exit
+            pass
+    else:
+        lm.run()
+
+    if isinstance(sink, MemorySink):
+        for t, etype, code, value in sink.events:
+            print("{:.6f} {} {} {}".format(t, etype, code, value))
+
+################################################################################